@@ -0,0 +1,311 @@
+""" Benchmarks of the timing and display hot paths of the race management system
+
+Run all benchmarks and store the results:
+prompt> python3 benchmark.py -o before.json
+
+Compare a later run against them, the exit status is 1 if anything got
+slower than the threshold:
+prompt> python3 benchmark.py -o after.json --compare before.json
+"""
+
+import argparse, json, os, platform, statistics, subprocess, sys, time, timeit
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from carreralib import ControlUnit, protocol
+
+from cusim import RaceSimulator, SimControlUnit
+from raceengine import RaceDriver, RaceEngine, posgetter
+from standings import Standings
+
+# number of timing runs per benchmark, the median is reported
+REPEAT = 5
+
+# relative slowdown reported as regression by --compare
+THRESHOLD = 0.1
+
+benchmarks = {}
+
+
+def benchmark(func):
+    """Register a benchmark, `func` returns the callable to be timed."""
+    benchmarks[func.__name__] = func
+    return func
+
+
+def raceEvents(count, cars=8):
+    simulator = RaceSimulator(cars, pitChance=0.1, seed=1)
+    return [simulator.step() for _ in range(count)]
+
+
+@benchmark
+def formattime():
+    from rms import formattime
+
+    times = list(range(0, 4000000, 4001))
+
+    def run():
+        for t in times:
+            formattime(t)
+            formattime(t, True)
+
+    return run
+
+
+@benchmark
+def posgetter_sort():
+    drivers = [RaceDriver(num) for num in range(1, 9)]
+    for idx, driver in enumerate(drivers):
+        driver.lapcount = idx % 3
+        driver.time = 1000 * idx
+
+    def run():
+        sorted(drivers, key=posgetter)
+
+    return run
+
+
+@benchmark
+def standings_update():
+    drivers = [RaceDriver(num) for num in range(1, 9)]
+    standings = Standings(posgetter)
+    timers = [
+        event for event in raceEvents(2000) if isinstance(event, ControlUnit.Timer)
+    ]
+
+    def run():
+        standings.clear()
+        for driver in drivers:
+            driver.clear()
+        for timer in timers:
+            driver = drivers[timer.address]
+            driver.newlap(timer)
+            standings.update(driver)
+
+    return run
+
+
+@benchmark
+def newlap():
+    driver = RaceDriver(1)
+    timers = [ControlUnit.Timer(0, 4000 * n, 1) for n in range(1000)]
+
+    def run():
+        driver.clear()
+        for timer in timers:
+            driver.newlap(timer)
+
+    return run
+
+
+@benchmark
+def handle_timer_sectors():
+    engine = RaceEngine()
+    simulator = RaceSimulator(8, pitChance=0.1, sectors=True, seed=1)
+    timers = [
+        event
+        for event in (simulator.step() for _ in range(3000))
+        if isinstance(event, ControlUnit.Timer)
+    ]
+
+    def run():
+        engine.reset()
+        for timer in timers:
+            engine.handle_timer(timer, 0.0)
+
+    return run
+
+
+@benchmark
+def handle_status():
+    engine = RaceEngine()
+    statuses = [
+        ControlUnit.Status(
+            tuple((n + car) % 16 for car in range(8)),
+            0,
+            5,
+            tuple((n >> car) & 1 == 1 for car in range(8)),
+            8,
+        )
+        for n in range(256)
+    ]
+
+    def run():
+        for status in statuses:
+            engine.handle_status(status)
+
+    return run
+
+
+@benchmark
+def unpack_datagrams():
+    status = protocol.pack("cc8YYYBYC", b"?", b":", *range(8), 0, 5, 0x55, 8)
+    timer = protocol.pack("cYIYC", b"?", 3, 123456789, 1)
+
+    def run():
+        for _ in range(100):
+            protocol.unpack("2x8YYYBYC", status)
+            protocol.unpack("xYIYC", timer)
+
+    return run
+
+
+@benchmark
+def decode_datagrams():
+    from datagram import StatusDecoder, decodeTimer
+
+    decodeStatus = StatusDecoder()
+    status = protocol.pack("cc8YYYBYC", b"?", b":", *range(8), 0, 5, 0x55, 8)
+    timer = protocol.pack("cYIYC", b"?", 3, 123456789, 1)
+
+    def run():
+        for _ in range(100):
+            decodeStatus(status)
+            decodeTimer(timer)
+
+    return run
+
+
+@benchmark
+def receivedUDP():
+    # rms_UDP.py imports carreralib's protocol.py as top-level module
+    sys.modules.setdefault("protocol", protocol)
+    import rms_UDP
+    from PyQt5.QtNetwork import QUdpSocket
+
+    class Window:
+        def handle_data(self, data):
+            pass
+
+    rms_UDP.w = Window()
+    cu = rms_UDP.ControlUnit(QUdpSocket())
+    status = protocol.pack("cc8YYYBYC", b"?", b":", *range(8), 0, 5, 0x55, 8)
+    timer = protocol.pack("cYIYC", b"?", 3, 123456789, 1)
+    item = (cu.POLL_PRIORITY, 0, cu.POLL_REQUEST, cu.REQUEST_TIMEOUT, 0)
+
+    def run():
+        for seq in range(100):
+            cu.inflight[seq] = item
+            cu.receivedUDP(b"%d#%s" % (seq, timer if seq % 4 == 0 else status))
+
+    return run
+
+
+def rmsFrame():
+    from rms import CUPoller, QApplication, RmsFrame
+    from transport import LocalTransport
+
+    global app
+    app = QApplication.instance() or QApplication(sys.argv)
+    cu = SimControlUnit(RaceSimulator(8))
+    frame = RmsFrame(CUPoller(LocalTransport(cu)), logFile=None)
+    frame.resize(1280, 800)
+    frame.show()
+    return frame
+
+
+@benchmark
+def updateDisplay_full():
+    frame = rmsFrame()
+    for event in raceEvents(200):
+        if isinstance(event, ControlUnit.Timer):
+            frame.engine.handle_timer(event)
+    frame.updateDisplay("0101")
+
+    def run():
+        frame.viewModel.clear()
+        frame.updateDisplay("0101")
+        app.processEvents()
+
+    return run
+
+
+@benchmark
+def updateDisplay_lap():
+    frame = rmsFrame()
+    simulator = RaceSimulator(8, pitChance=0.1, seed=1)
+
+    def run():
+        while True:
+            event = simulator.step()
+            if isinstance(event, ControlUnit.Timer):
+                frame.engine.handle_timer(event)
+                break
+            frame.engine.handle_status(event)
+        frame.updateDisplay("0101")
+        app.processEvents()
+
+    return run
+
+
+def measure(run):
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(REPEAT, number)]
+    return {"median": statistics.median(times), "min": min(times), "number": number}
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["median"] / baseline[name]["median"] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(
+            "%-20s %+7.1f%%%s"
+            % (name, change * 100, "  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", help="store the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("names", nargs="*", help="benchmarks to run, default all")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in benchmarks.items():
+        if args.names and name not in args.names:
+            continue
+        results[name] = measure(func())
+        print("%-20s %10.1f us" % (name, results[name]["median"] * 1e6))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": commit(),
+                    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
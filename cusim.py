@@ -0,0 +1,249 @@
+""" Synthetic Carrera(R) Digital 124/132 Control Unit for stress tests """
+
+import argparse, heapq, itertools, random, socket, time
+
+from carreralib import ControlUnit, protocol
+
+# prefix of the device argument of rms.py that selects the simulator
+DEVICE_PREFIX = "sim:"
+
+# a CU knows eight controllers
+MAX_CARS = 8
+
+# mode bits reported in the status: pit lane exists, fuel mode on
+MODE = 0b0101
+
+# full tank
+FUEL_MAX = 15
+
+
+class RaceSimulator:
+    """Generates the events of a race with `cars` cars.
+
+    Lap times are normally distributed around `lapTime` ms. Each lap a
+    car burns `fuelBurn` units of fuel and with `pitChance` it stops in
+    the pit lane for `pitTime` ms, which fills up the tank. With
+    `sectors` every lap also passes two check lanes, reported as timer
+    events of sector 2 and 3. The same `seed` gives the same race.
+
+    :meth:`step` advances the simulated CU clock to the next event and
+    returns it as ControlUnit.Timer, or as ControlUnit.Status if the
+    status changed.
+    """
+
+    def __init__(
+        self,
+        cars=6,
+        lapTime=4000,
+        lapTimeSpread=300,
+        pitChance=0.05,
+        pitTime=3000,
+        fuelBurn=0.5,
+        sectors=False,
+        seed=None,
+    ):
+        if not 1 <= cars <= MAX_CARS:
+            raise ValueError("Number of cars out of range")
+        self.cars = cars
+        self.lapTime = lapTime
+        self.lapTimeSpread = lapTimeSpread
+        self.pitChance = pitChance
+        self.pitTime = pitTime
+        self.fuelBurn = fuelBurn
+        self.sectors = sectors
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        """Restart the race and the CU clock."""
+        self.random = random.Random(self.seed)
+        self.now = 0
+        self.events = []
+        self.order = itertools.count()
+        self.fuel = [float(FUEL_MAX)] * MAX_CARS
+        self.pit = [False] * MAX_CARS
+        for car in range(self.cars):
+            # the cars cross the line for the first time one after another
+            self.schedule(self.random.uniform(0, self.lapTime), "lap", car)
+
+    def schedule(self, timestamp, kind, car, sector=1):
+        heapq.heappush(
+            self.events, (int(timestamp), next(self.order), kind, car, sector)
+        )
+
+    def status(self):
+        return ControlUnit.Status(
+            tuple(int(fuel) for fuel in self.fuel), 0, MODE, tuple(self.pit), MAX_CARS
+        )
+
+    def nextTimestamp(self):
+        """CU time of the next event."""
+        return self.events[0][0]
+
+    def step(self):
+        timestamp, _, kind, car, sector = heapq.heappop(self.events)
+        self.now = timestamp
+        if kind == "lap":
+            lapTime = max(
+                self.lapTime / 2, self.random.gauss(self.lapTime, self.lapTimeSpread)
+            )
+            if self.sectors:
+                self.schedule(timestamp + lapTime / 3, "sector", car, 2)
+                self.schedule(timestamp + lapTime * 2 / 3, "sector", car, 3)
+            if self.random.random() < self.pitChance:
+                self.schedule(timestamp + lapTime / 2, "pitIn", car)
+                self.schedule(timestamp + lapTime / 2 + self.pitTime, "pitOut", car)
+                lapTime += self.pitTime
+            self.schedule(timestamp + lapTime, "lap", car)
+            self.fuel[car] = max(0.0, self.fuel[car] - self.fuelBurn)
+            return ControlUnit.Timer(car, timestamp, 1)
+        elif kind == "sector":
+            return ControlUnit.Timer(car, timestamp, sector)
+        elif kind == "pitIn":
+            self.pit[car] = True
+            self.fuel[car] = float(FUEL_MAX)
+        elif kind == "pitOut":
+            self.pit[car] = False
+        return self.status()
+
+
+class SimControlUnit:
+    """Drives a RaceSimulator through the carreralib ControlUnit API.
+
+    The simulated CU clock runs `speed` times as fast as the real one.
+    With a `speed` of 0 every poll returns the next event, so the event
+    rate is only limited by the poll rate. Commands other than reset
+    are accepted and ignored.
+    """
+
+    Status = ControlUnit.Status
+    Timer = ControlUnit.Timer
+
+    def __init__(self, simulator, speed=1.0):
+        self.simulator = simulator
+        self.speed = speed
+        self.started = time.monotonic()
+
+    @classmethod
+    def fromDevice(cls, device):
+        """Create the simulator for a device argument like sim:CARS@SPEED.
+
+        SPEED is a factor of real time or "max", default is 1.
+        """
+        cars, _, speed = device[len(DEVICE_PREFIX) :].partition("@")
+        simulator = RaceSimulator(int(cars or 6))
+        if speed == "max":
+            return cls(simulator, 0)
+        return cls(simulator, float(speed or 1))
+
+    def poll(self):
+        if self.speed:
+            now = (time.monotonic() - self.started) * 1000 * self.speed
+            if self.simulator.nextTimestamp() > now:
+                return self.simulator.status()
+        return self.simulator.step()
+
+    def request(self, buf, maxlength=None):
+        return None
+
+    def start(self):
+        pass
+
+    def reset(self):
+        self.simulator.reset()
+        self.started = time.monotonic()
+
+    def clrpos(self):
+        pass
+
+    def version(self):
+        return "sim"
+
+    def close(self):
+        pass
+
+
+def answer(cu, command):
+    """Answer to a request in the dialect of the btserver bridge."""
+    if command == b"Version":
+        return protocol.pack("c4sC", b"0", b"5337")
+    elif command in (b"generalQuery", b"clearCU"):
+        data = cu.poll()
+        if isinstance(data, ControlUnit.Timer):
+            reply = protocol.pack(
+                "cYIYC", b"?", data.address + 1, data.timestamp, data.sector
+            )
+        else:
+            pitmask = sum(1 << n for n, pit in enumerate(data.pit) if pit)
+            reply = protocol.pack(
+                "cc8YYYBYC",
+                b"?",
+                b":",
+                *data.fuel,
+                data.start,
+                data.mode,
+                pitmask,
+                data.display
+            )
+        # the "?" of the query is left out of the checksum, so the bridge
+        # can put "clearCU&" in its place and the checksum still holds
+        if command == b"clearCU":
+            return b"clearCU&" + reply[1:]
+        return reply
+    elif command == b"Reset":
+        cu.reset()
+        return b"Reset&:"
+    elif command == b"prog":
+        return None
+    return command + b"&" + command
+
+
+def serve(cu, host="127.0.0.1", port=8888):
+    """Answer the requests of rms_UDP.py like the btserver bridge does."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    while True:
+        datagram, address = sock.recvfrom(1024)
+        seq, sep, request = datagram.partition(b"#")
+        if not sep:
+            seq, request = None, datagram
+        reply = answer(cu, request.split(b"&")[0])
+        if reply is None:
+            continue
+        if seq is not None:
+            reply = seq + b"#" + reply
+        sock.sendto(reply, address)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a Control Unit behind the btserver UDP bridge"
+    )
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--cars", type=int, default=6)
+    parser.add_argument("--lap-time", type=int, default=4000, help="in ms")
+    parser.add_argument("--lap-time-spread", type=int, default=300, help="in ms")
+    parser.add_argument("--pit-chance", type=float, default=0.05)
+    parser.add_argument("--pit-time", type=int, default=3000, help="in ms")
+    parser.add_argument("--fuel-burn", type=float, default=0.5, help="per lap")
+    parser.add_argument("--sectors", action="store_true", help="check lane events")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="factor of real time, 0 for max"
+    )
+    args = parser.parse_args()
+    simulator = RaceSimulator(
+        args.cars,
+        args.lap_time,
+        args.lap_time_spread,
+        args.pit_chance,
+        args.pit_time,
+        args.fuel_burn,
+        args.sectors,
+        args.seed,
+    )
+    serve(SimControlUnit(simulator, args.speed), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
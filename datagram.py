@@ -0,0 +1,89 @@
+"""Fast decoding of the datagrams of the Control Unit"""
+
+# the CU sends every nibble as the character 0x30 + nibble, the low four
+# bits of any character are its value
+NIBBLES = bytes(c & 0x0F for c in range(256))
+
+# pit lane flags of the eight cars for every pit mask
+PIT_FLAGS = tuple(tuple(mask & (1 << n) != 0 for n in range(8)) for mask in range(256))
+
+# offsets within "?:" + 8 fuel + start + mode + pit mask (2) + display
+FUEL = slice(2, 10)
+START = 10
+MODE = 11
+PIT_LOW = 12
+PIT_HIGH = 13
+DISPLAY = 14
+# the checksum follows the display, some CU firmwares send two more
+# characters before it
+CHECKSUM_OFFSETS = (15, 17)
+
+# offsets within "?" + address + 32-bit timestamp + sector
+ADDRESS = 1
+TIMESTAMP = 2
+SECTOR = 10
+TIMER_CHECKSUM = 11
+
+
+def checksum(buf, start, end):
+    """Whether the character at `end` is the checksum of buf[start + 1:end]."""
+    return sum(buf[start + 1 : end]) & 0x0F == buf[end] & 0x0F
+
+
+class StatusDecoder:
+    """Decodes "?:" status answers into (fuel, start, mode, pit, display).
+
+    Does the same as protocol.unpack("2x8YYYBYC", buf) and building the
+    pit tuple, with table lookups instead of per character Python code.
+    The status starts at `pos` within `buf`, so answers need not be cut
+    out of the datagram they arrived in.
+
+    Which of the CHECKSUM_OFFSETS the firmware of the CU uses is learned
+    from the first status with a valid checksum, later ones are only
+    checked at that offset. Calls return None if the checksum is wrong.
+    """
+
+    def __init__(self):
+        self.checksumOffset = None
+
+    def __call__(self, buf, pos=0):
+        offset = self.checksumOffset
+        if offset is None or not (
+            len(buf) > pos + offset and checksum(buf, pos, pos + offset)
+        ):
+            offset = self.learn(buf, pos)
+            if offset is None:
+                return None
+        return (
+            tuple(buf[pos + FUEL.start : pos + FUEL.stop].translate(NIBBLES)),
+            buf[pos + START] & 0x0F,
+            buf[pos + MODE] & 0x0F,
+            PIT_FLAGS[(buf[pos + PIT_LOW] & 0x0F) | (buf[pos + PIT_HIGH] & 0x0F) << 4],
+            buf[pos + DISPLAY] & 0x0F,
+        )
+
+    def learn(self, buf, pos):
+        for offset in CHECKSUM_OFFSETS:
+            if len(buf) > pos + offset and checksum(buf, pos, pos + offset):
+                self.checksumOffset = offset
+                return offset
+        return None
+
+
+def decodeTimer(buf, pos=0):
+    """Decode a timer answer "?" + YIYC into (address, timestamp, sector).
+
+    Same as protocol.unpack("xYIYC", buf[pos:]), returns None if the
+    checksum is wrong.
+    """
+    if len(buf) <= pos + TIMER_CHECKSUM or not checksum(buf, pos, pos + TIMER_CHECKSUM):
+        return None
+    n = buf[pos + TIMESTAMP : pos + SECTOR].translate(NIBBLES)
+    return (
+        buf[pos + ADDRESS] & 0x0F,
+        (n[0] | n[1] << 4) << 24
+        | (n[2] | n[3] << 4) << 16
+        | (n[4] | n[5] << 4) << 8
+        | (n[6] | n[7] << 4),
+        buf[pos + SECTOR] & 0x0F,
+    )
@@ -0,0 +1,91 @@
+""" Lap history of the race management system, one set of columns per car """
+
+from array import array
+import math
+
+
+class LapHistory:
+    """Every lap of one controller, stored column by column.
+
+    Each column is an :class:`array.array` of fixed-size machine values,
+    so a lap costs 25 bytes instead of a Python object and even a 24h
+    race with thousands of laps per car stays small and flat in memory.
+    Sums over the lap times are kept while laps are appended, so the
+    average, the consistency (standard deviation) and the pace trend
+    are available at any time without going over the laps again.
+    :meth:`column` returns a column as NumPy array for anything else.
+    """
+
+    def __init__(self):
+        # race time, which may exceed the 32 bits of the CU clock
+        self.timestamps = array("Q")
+        self.lapTimes = array("i")
+        # split of each sector in ms, 0 if the sector was not timed
+        self.sector1 = array("i")
+        self.sector2 = array("i")
+        self.sector3 = array("i")
+        self.pits = array("B")
+        self.sum = 0
+        self.sumSquares = 0
+        self.sumIndexed = 0
+
+    def __len__(self):
+        return len(self.lapTimes)
+
+    def append(self, timestamp, lapTime, splits=None, pit=False):
+        """Add a lap finished at `timestamp` after `lapTime` ms.
+
+        `splits` maps the sectors of the lap to their split in ms.
+        """
+        if splits is None:
+            splits = {}
+        self.sumIndexed += len(self.lapTimes) * lapTime
+        self.timestamps.append(timestamp)
+        self.lapTimes.append(lapTime)
+        self.sector1.append(splits.get(1, 0))
+        self.sector2.append(splits.get(2, 0))
+        self.sector3.append(splits.get(3, 0))
+        self.pits.append(pit)
+        self.sum += lapTime
+        self.sumSquares += lapTime * lapTime
+
+    def mean(self):
+        """Average lap time in ms, or None without any laps."""
+        if not self.lapTimes:
+            return None
+        return self.sum / len(self.lapTimes)
+
+    def stdev(self):
+        """Standard deviation of the lap times in ms, lower is more consistent."""
+        n = len(self.lapTimes)
+        if n < 2:
+            return None
+        # the sums are exact integers, so this does not lose precision
+        return math.sqrt((n * self.sumSquares - self.sum * self.sum) / (n * (n - 1)))
+
+    def trend(self):
+        """Change of the lap time per lap in ms, negative while getting faster."""
+        n = len(self.lapTimes)
+        if n < 2:
+            return None
+        # least squares slope over lap index 0..n-1, using the closed forms
+        # of the sums over the index
+        sumIndex = n * (n - 1) // 2
+        sumIndexSquares = (n - 1) * n * (2 * n - 1) // 6
+        return (n * self.sumIndexed - sumIndex * self.sum) / (
+            n * sumIndexSquares - sumIndex * sumIndex
+        )
+
+    def column(self, name):
+        """Copy of column `name`, e.g. "lapTimes", as a NumPy array.
+
+        A view would lock the size of the array, so a copy is made, which
+        is a single memcpy. Without NumPy a copy of the array is returned.
+        """
+        values = getattr(self, name)
+        try:
+            # only imported here, it takes longer than starting the rms
+            import numpy
+        except ImportError:
+            return array(values.typecode, values)
+        return numpy.frombuffer(values, dtype=values.typecode).copy()
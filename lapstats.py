@@ -0,0 +1,159 @@
+""" Rolling lap statistics and predictions of the race management system
+
+The driver grid shows them in optional columns, enabled by setting the
+environment variable RMS_STATS to "all" or some of the column keys, e.g.:
+prompt> RMS_STATS=mean,fuelLaps python3 rms.py <CU BT Address>
+"""
+
+from collections import deque
+import math, os
+
+# number of laps the rolling average and deviation are taken over
+WINDOW = 5
+
+# optional columns of the driver grid as (key, header)
+COLUMNS = (
+    ("mean", "Avg Lap"),
+    ("stdev", "Spread"),
+    ("position", "Pred. Pos"),
+    ("fuelLaps", "Fuel Laps"),
+)
+
+
+def enabledColumns(spec=None):
+    """The COLUMNS selected by `spec`, by default the value of RMS_STATS."""
+    if spec is None:
+        spec = os.environ.get("RMS_STATS", "")
+    if spec == "all":
+        return COLUMNS
+    keys = spec.split(",")
+    return tuple(column for column in COLUMNS if column[0] in keys)
+
+
+class LapStats:
+    """Rolling statistics of the laps of one car.
+
+    The mean and the standard deviation of the last `window` laps are
+    kept with Welford's method, which adds the new lap and takes out the
+    one leaving the window in O(1), without summing up the laps again.
+    Laps with a pit stop are left out, they say nothing about the pace.
+    The fuel used per lap is a running mean as well, over all laps
+    without refuelling, so the laps left on any fuel level are known at
+    any time.
+    """
+
+    __slots__ = (
+        "window",
+        "laps",
+        "mean",
+        "m2",
+        "fuel",
+        "burnCount",
+        "burnMean",
+        "position",
+    )
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.clear()
+
+    def clear(self):
+        self.laps = deque()
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.fuel = None
+        self.burnCount = 0
+        self.burnMean = 0.0
+        # predicted finishing position, set by predictPositions()
+        self.position = None
+
+    def lap(self, lapTime, fuel, pit=False):
+        """Account for a lap of `lapTime` ms with `fuel` left at its end."""
+        if pit:
+            # the tank was filled up, start measuring the fuel again
+            self.fuel = fuel
+            return
+        laps = self.laps
+        if len(laps) == self.window:
+            old = laps.popleft()
+            if laps:
+                delta = old - self.mean
+                self.mean -= delta / len(laps)
+                self.m2 -= delta * (old - self.mean)
+            else:
+                self.mean = 0.0
+                self.m2 = 0.0
+        laps.append(lapTime)
+        delta = lapTime - self.mean
+        self.mean += delta / len(laps)
+        self.m2 += delta * (lapTime - self.mean)
+        if self.fuel is not None and fuel <= self.fuel:
+            self.burnCount += 1
+            self.burnMean += (self.fuel - fuel - self.burnMean) / self.burnCount
+        self.fuel = fuel
+
+    def meanLap(self):
+        """Average of the last laps in ms, None without any."""
+        if not self.laps:
+            return None
+        return self.mean
+
+    def stdev(self):
+        """Standard deviation of the last laps in ms, None before two laps."""
+        if len(self.laps) < 2:
+            return None
+        return math.sqrt(max(self.m2, 0.0) / (len(self.laps) - 1))
+
+    def fuelLaps(self, fuel):
+        """Laps left on `fuel` in the tank, None until fuel is used."""
+        if self.burnMean <= 0:
+            return None
+        return fuel / self.burnMean
+
+
+def formatstat(driver, key):
+    """Text of the column `key` for a RaceDriver, "-" if not known yet."""
+    stats = driver.stats
+    if key == "mean":
+        value = stats.meanLap()
+        return "-" if value is None else "%d.%03d" % divmod(int(value), 1000)
+    elif key == "stdev":
+        value = stats.stdev()
+        return "-" if value is None else "%.3f" % (value / 1000)
+    elif key == "position":
+        return "-" if stats.position is None else str(stats.position)
+    elif key == "fuelLaps":
+        # the current level, which changes while the car is refuelled
+        value = stats.fuelLaps(driver.fuellevel)
+        return "-" if value is None else "%.1f" % value
+    return "-"
+
+
+def predictPositions(drivers, session, start):
+    """Set the predicted finishing position of `drivers`.
+
+    Every driver is assumed to keep lapping at the average of their last
+    laps. In a "Laps" session the order is that of the predicted time
+    of crossing the line for the last time, in a "Timed" session that of
+    the laps done when the time is up. Otherwise it is the current order.
+    As there are at most eight drivers this is O(1) per lap.
+    """
+
+    def finish(driver):
+        mean = driver.stats.meanLap()
+        if driver.time is None:
+            return (2, 0, 0)
+        if mean is None or start is None:
+            # nothing to predict from, behind those with a prediction
+            return (1, -driver.lapcount, driver.time)
+        if session.type == "Laps":
+            # the session is over once the leader did more than amount laps
+            left = max(0, session.amount + 1 - driver.lapcount)
+            return (0, 0, driver.time + left * mean)
+        elif session.type == "Timed":
+            left = int(max(0, start + session.amount * 60000 - driver.time) / mean)
+            return (0, -(driver.lapcount + left), driver.time + left * mean)
+        return (0, -driver.lapcount, driver.time)
+
+    for position, driver in enumerate(sorted(drivers, key=finish), start=1):
+        driver.stats.position = position
@@ -0,0 +1,140 @@
+""" Latency probes for the path of a timer event from the CU to the display
+
+Probes are off unless the environment variable RMS_LATENCY is set to the
+file the measurements are exported to when the rms exits, e.g.:
+prompt> RMS_LATENCY=latency.json python3 rms.py <CU BT Address>
+
+When they are off :data:`tracer` is None and every probe costs one check
+of a module attribute.
+"""
+
+import json, math, os, threading, time
+
+# stages an event passes after it was received, in this order; rms.py
+# gets the events decoded and has no decode stage
+STAGES = ("decode", "handle", "model", "paint")
+
+# histogram buckets grow by this factor, i.e. about 19% per bucket
+BUCKET_BASE = 2**0.25
+
+# latencies up to 2**30 ns (about a second) get their own bucket
+BUCKET_COUNT = 121
+
+
+class Histogram:
+    """Counts of latencies in ns in exponentially growing buckets.
+
+    Recording is O(1) and needs no memory per sample, the percentiles
+    are accurate to the bucket width.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.max = 0
+
+    def record(self, ns):
+        if ns < 1:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(ns, BUCKET_BASE)), BUCKET_COUNT - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        """Upper bound of the `p` percentile in ns, None without samples."""
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BUCKET_BASE ** (bucket + 1), self.max)
+        return self.max
+
+
+class Tracer:
+    """Records how long after being received an event passes each stage.
+
+    Events are identified by their value, e.g. the Timer namedtuple. The
+    receive stage starts the clock of an event, every later stage adds
+    the time since then to the histogram of the stage. The paint stage
+    is passed by all open events at once when the display is refreshed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.open = {}
+        self.lock = threading.Lock()
+
+    def arrived(self):
+        """Time of the arrival of data that is decoded into an event later,
+        to be passed to :meth:`receive` with the event."""
+        return time.perf_counter_ns()
+
+    def receive(self, event, ns=None):
+        if ns is None:
+            ns = time.perf_counter_ns()
+        with self.lock:
+            self.open[event] = ns
+
+    def stage(self, event, stage):
+        received = self.open.get(event)
+        if received is not None:
+            self.histograms[stage].record(time.perf_counter_ns() - received)
+
+    def paint(self):
+        now = time.perf_counter_ns()
+        with self.lock:
+            events, self.open = self.open, {}
+        for received in events.values():
+            self.histograms["paint"].record(now - received)
+
+    def summary(self):
+        """p50/p95/p99 and max of every stage in ms."""
+        result = {}
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                result[stage] = {
+                    "count": histogram.count,
+                    "p50": histogram.percentile(50) / 1e6,
+                    "p95": histogram.percentile(95) / 1e6,
+                    "p99": histogram.percentile(99) / 1e6,
+                    "max": histogram.max / 1e6,
+                }
+        return result
+
+    def report(self):
+        """Summary as text table for the debug overlay."""
+        lines = ["%-8s %6s %8s %8s %8s" % ("ms", "n", "p50", "p95", "p99")]
+        for stage, values in self.summary().items():
+            lines.append(
+                "%-8s %6d %8.2f %8.2f %8.2f"
+                % (stage, values["count"], values["p50"], values["p95"], values["p99"])
+            )
+        return "\n".join(lines)
+
+    def export(self, path=None):
+        """Write the summary and the raw histograms as JSON."""
+        with open(path or self.path, "w") as f:
+            json.dump(
+                {
+                    "summary": self.summary(),
+                    "bucketBase": BUCKET_BASE,
+                    "histograms": {
+                        stage: histogram.counts
+                        for stage, histogram in self.histograms.items()
+                    },
+                },
+                f,
+                indent=2,
+            )
+
+
+tracer = None
+if os.environ.get("RMS_LATENCY"):
+    tracer = Tracer(os.environ["RMS_LATENCY"])
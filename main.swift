@@ -19,14 +19,19 @@ class btserver: NSObject {
     var port: NWEndpoint.Port
     var listener: NWListener
     var connection: ServerConnection?
-    var command: String
+    // requests written to the CU which are still waiting for an answer,
+    // the CU answers them one after the other in the order they were written
+    var pending: [(seq: String?, command: String, written: Character?, sent: Date)] = []
+    let maxPending = 16
+    // seconds after which the CU lost a request, well above REQUEST_TIMEOUT
+    // of rms_UDP, which sends it again with a new sequence number anyway
+    let requestLostAfter: TimeInterval = 2.0
     let allowedCmds = ["Version", "generalQuery", "Reset", "clearCU"]
     
     override init() {
         print("init btserver")
         port = NWEndpoint.Port(rawValue: 8888)!
         listener = try! NWListener(using: .udp, on: port)
-        command = ""
         super.init()
         startUDPlistener()
         btscanner.delegate = self
@@ -63,13 +68,20 @@ class btserver: NSObject {
     }
 
     @objc func methodOfReceivedNotification(notification: Notification) {
-        let writeString = notification.object as! String
+        var writeString = notification.object as! String
+        // requests start with a sequence number "<seq>#" which is copied
+        // into the answer so the client can match answers to requests
+        var seq: String? = nil
+        if let hash = writeString.firstIndex(of: "#") {
+            seq = String(writeString[..<hash])
+            writeString = String(writeString[writeString.index(after: hash)...])
+        }
         let payload = writeString.split(separator: "&")
-        command = String(payload[0])
+        var command = String(payload[0])
         var cudata: String = ""
         if self.connectedPeripheral == nil {
             cudata = "nocu"
-            self.connection?.send(data: cudata.data(using: .utf8)!)
+            self.send(cudata, seq: seq)
             return
         }
         if let i = allowedCmds.firstIndex(where: {$0 == command}) {
@@ -91,9 +103,22 @@ class btserver: NSObject {
         } else {
             cudata = String(payload[0])
         }
+        pending.append((seq: seq, command: command, written: cudata.first, sent: Date()))
+        if pending.count > maxPending {
+            // the CU lost some requests, don't let the queue grow forever
+            pending.removeFirst(pending.count - maxPending)
+        }
         let writeData:Data? = cudata.data(using: String.Encoding.ascii)
         writeDataToSelectedCharacteristic(writeData!)
     }
+
+    func send(_ answer: String, seq: String?) {
+        var datagram = answer
+        if let seq = seq {
+            datagram = seq + "#" + answer
+        }
+        self.connection?.send(data: datagram.data(using: .utf8)!)
+    }
     
     func writeDataToSelectedCharacteristic(_ data:Data) {
         if let characteristic = selectedCharacteristic {
@@ -145,6 +170,7 @@ extension btserver : CBCentralManagerDelegate {
         if let connectedPeripheral = connectedPeripheral {
             print((connectedPeripheral.name ?? "") + ":\n disconnected")
             self.connectedPeripheral = nil
+            pending.removeAll()
             btscanner.start()
             listUpdateTimer = Timer.scheduledTimer(timeInterval: 0.5, target: self, selector: #selector(btserver.listUpdateTimerFired), userInfo: nil, repeats: true)
         } else {
@@ -200,6 +226,19 @@ extension btserver : CBPeripheralDelegate {
     
     func peripheral(_ peripheral: CBPeripheral, didUpdateValueFor characteristic: CBCharacteristic, error: Error?) {
         if let ascii = String(data: characteristic.value ?? Data(), encoding: String.Encoding.ascii) {
+            // the CU starts every answer with the first character of its
+            // request, like carreralib the answer is matched by that; the
+            // requests before the one answered were lost, as were those
+            // which are too old, otherwise every later answer would go out
+            // with the sequence number and command of the one before
+            let now = Date()
+            pending.removeAll(where: { now.timeIntervalSince($0.sent) > requestLostAfter })
+            guard let index = pending.firstIndex(where: { $0.written == ascii.first }) else {
+                // a late answer to a request which was already dropped
+                return
+            }
+            let (seq, command, _, _) = pending[index]
+            pending.removeFirst(index + 1)
             var cmdString: String = ""
             if command == "?" || command == "0" {
                 cmdString = command + ascii
@@ -208,7 +247,7 @@ extension btserver : CBPeripheralDelegate {
             } else {
                 cmdString = command + "&" + ascii
             }
-            self.connection?.send(data: cmdString.data(using: .utf8)!)
+            send(cmdString, seq: seq)
         }
     }
     
@@ -0,0 +1,109 @@
+""" Metrics of the race management system in the Prometheus text format
+
+The HTTP endpoint is off unless the environment variable RMS_METRICS_PORT
+is set to the port it should listen on, e.g.:
+prompt> RMS_METRICS_PORT=9100 python3 rms.py <CU BT Address>
+prompt> curl http://localhost:9100/metrics
+
+When it is off :data:`registry` is None and every update costs one check
+of a module attribute.
+"""
+
+import os, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    """Counters, gauges and summaries to be scraped by Prometheus.
+
+    Values are plain numbers updated in place without locking. Each
+    metric is only updated from one thread, the HTTP thread only reads
+    them. Gauges may also be functions which are called on every scrape,
+    e.g. to report the length of a queue.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.samples = {}
+
+    def counter(self, name, help, labels=()):
+        self.add(name, "counter", help, [name + label for label in labels or ("",)])
+
+    def gauge(self, name, help, value=0):
+        self.add(name, "gauge", help, [name])
+        self.samples[name] = value
+
+    def summary(self, name, help):
+        self.add(name, "summary", help, [name + "_sum", name + "_count"])
+
+    def add(self, name, kind, help, samples):
+        self.metrics[name] = (kind, help, samples)
+        for sample in samples:
+            self.samples.setdefault(sample, 0)
+
+    def inc(self, sample, value=1):
+        self.samples[sample] += value
+
+    def set(self, sample, value):
+        self.samples[sample] = value
+
+    def observe(self, name, value):
+        self.samples[name + "_sum"] += value
+        self.samples[name + "_count"] += 1
+
+    def render(self):
+        lines = []
+        for name, (kind, help, samples) in list(self.metrics.items()):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for sample in samples:
+                value = self.samples[sample]
+                if callable(value):
+                    value = value()
+                lines.append("%s %s" % (sample, float(value)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(registry, port, host=""):
+    """Serve `registry` on `port` from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+registry = None
+if os.environ.get("RMS_METRICS_PORT"):
+    registry = Registry()
+    registry.counter("rms_polls_total", "Polls of the CU")
+    registry.counter(
+        "rms_events_total",
+        "New status and timer events from the CU",
+        ['{kind="status"}', '{kind="timer"}'],
+    )
+    registry.counter(
+        "rms_duplicate_frames_total", "Polls answered with the same data as before"
+    )
+    registry.gauge("rms_poll_rate_hz", "Effective CU polls per second")
+    registry.summary("rms_frame_seconds", "Time to update the driver grid")
+    serve(registry, int(os.environ["RMS_METRICS_PORT"]))
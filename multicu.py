@@ -0,0 +1,207 @@
+""" Timing of several tracks, each with its own Control Unit, in one process
+
+Every device argument is one track, which may also be a replay: or sim:
+device as accepted by rms.py, e.g.:
+prompt> python3 multicu.py <CU 1 BT Address> <CU 2 BT Address> sim:4
+"""
+
+import heapq, itertools, queue, sys, threading, time
+
+from carreralib import ControlUnit
+
+from pollscheduler import PollScheduler
+from raceclock import RaceClock
+from raceengine import POLL_RATE, RaceEngine
+from sectortiming import FINISH_LINE
+from transport import openDevice
+
+# ms a timer event is held back before it is merged into the timeline, so
+# that events of a CU which is polled a bit later still end up in order
+MERGE_DELAY = 200
+
+
+class TrackClock:
+    """Maps the millisecond clock of one CU onto the shared timeline.
+
+    Each CU counts from its own power on or reset, the shared timeline
+    counts milliseconds of the host's monotonic clock since `epoch`. A
+    RaceClock makes the CU time monotonic across wrap arounds and resets,
+    the offset between that and the timeline is the smallest difference
+    between the time an event was received and its race time seen so
+    far, i.e. that of the event which was picked up fastest after it
+    happened.
+    """
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.clock = RaceClock()
+        self.offset = None
+
+    def normalise(self, timestamp, received):
+        """Time on the timeline of a CU `timestamp` received at `received`.
+
+        `received` is a value of time.monotonic().
+        """
+        race = self.clock.extend(timestamp, received)
+        offset = int((received - self.epoch) * 1000) - race
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+        return race + self.offset
+
+
+class Track:
+    """One CU with its own race engine, i.e. its own drivers and standings."""
+
+    def __init__(self, name, cu, clock, rate=POLL_RATE):
+        self.name = name
+        self.cu = cu
+        self.clock = clock
+        self.engine = RaceEngine()
+        self.scheduler = PollScheduler(rate)
+        self.thread = None
+
+    def __repr__(self):
+        return "Track(%r)" % self.name
+
+
+class MultiCU:
+    """Polls the CUs of several tracks concurrently.
+
+    Every CU is polled by a thread of its own, which hands new events to
+    the thread calling :meth:`process`, so the race engines of the
+    tracks are only ever touched by one thread. Status changes are
+    passed on at once. Timer events are put on the shared timeline by
+    the TrackClock of their track and merged in timeline order, after
+    they were held back for MERGE_DELAY ms. Subscribers are called with
+    (time, track, timer) for every merged timer event, after the race
+    engine of the track handled it.
+    """
+
+    def __init__(self, devices, names=None, rate=POLL_RATE):
+        self.epoch = time.monotonic()
+        names = names or ["Track %d" % (n + 1) for n in range(len(devices))]
+        self.tracks = [
+            Track(name, openDevice(device), TrackClock(self.epoch), rate)
+            for name, device in zip(names, devices)
+        ]
+        # (track, data, received) from the poll threads, or an exception
+        self.events = queue.Queue()
+        # timer events waiting to be merged as (time, order, track, timer)
+        self.pending = []
+        self.order = itertools.count()
+        self.subscribers = []
+        self.shutdown = threading.Event()
+
+    def subscribe(self, func):
+        self.subscribers.append(func)
+
+    def start(self):
+        for track in self.tracks:
+            track.thread = threading.Thread(
+                target=self.pollTrack, args=(track,), daemon=True
+            )
+            track.thread.start()
+
+    def pollTrack(self, track):
+        last = None
+        try:
+            while not self.shutdown.is_set():
+                data = track.cu.poll()
+                received = time.monotonic()
+                delay = track.scheduler.next(
+                    isinstance(data, ControlUnit.Timer), data == last
+                )
+                if data != last:
+                    self.events.put((track, data, received))
+                    last = data
+                self.shutdown.wait(delay)
+        except Exception as e:
+            self.events.put(e)
+
+    def now(self):
+        """Current time on the shared timeline."""
+        return int((time.monotonic() - self.epoch) * 1000)
+
+    def process(self, timeout=None):
+        """Handle the events from the poll threads.
+
+        Waits up to `timeout` seconds for the first one. Returns the
+        number of timer events merged into the timeline.
+        """
+        try:
+            item = self.events.get(timeout=timeout)
+            while True:
+                if isinstance(item, Exception):
+                    raise item
+                track, data, received = item
+                if isinstance(data, ControlUnit.Timer):
+                    heapq.heappush(
+                        self.pending,
+                        (
+                            track.clock.normalise(data.timestamp, received),
+                            next(self.order),
+                            track,
+                            data,
+                        ),
+                    )
+                elif isinstance(data, ControlUnit.Status):
+                    track.engine.handle_status(data)
+                item = self.events.get_nowait()
+        except queue.Empty:
+            pass
+        return self.merge(self.now() - MERGE_DELAY)
+
+    def merge(self, until):
+        """Merge the pending timer events up to time `until`."""
+        count = 0
+        while self.pending and self.pending[0][0] <= until:
+            ms, _, track, timer = heapq.heappop(self.pending)
+            track.engine.handle_timer(timer)
+            for func in self.subscribers:
+                func(ms, track, timer)
+            count += 1
+        return count
+
+    def close(self):
+        self.shutdown.set()
+        for track in self.tracks:
+            if track.thread is not None:
+                track.thread.join()
+            track.cu.close()
+        self.merge(sys.maxsize)
+
+
+def main(devices):
+    """Headless timing of all tracks printing every lap to stdout."""
+    multi = MultiCU(devices)
+
+    def printLap(ms, track, timer):
+        if timer.sector != FINISH_LINE:
+            # a Check Lane, the lap is printed at the start/finish line
+            return
+        driver = track.engine.drivers[timer.address]
+        if driver.lapTime is not None:
+            print(
+                "%8d.%03d %s %s lap %d %d.%03d"
+                % (
+                    *divmod(ms, 1000),
+                    track.name,
+                    driver.name,
+                    driver.lapcount,
+                    *divmod(driver.lapTime, 1000),
+                )
+            )
+
+    multi.subscribe(printLap)
+    multi.start()
+    try:
+        while True:
+            multi.process(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        multi.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,55 @@
+""" Adaptive poll scheduling for the Carrera(R) Digital 124/132 Control Unit """
+
+import time
+
+# polls per second while the track is quiet
+IDLE_RATE = 20
+
+# number of identical status frames before the poll rate is lowered
+IDLE_AFTER = 25
+
+
+class PollScheduler:
+    """Decides how long to wait before the next CU poll.
+
+    While timer events keep arriving the CU is polled back-to-back so
+    that lap times reach the display with the lowest possible latency.
+    Once `idleAfter` identical status frames have been seen in a row the
+    rate drops to `idleRate`, saving BLE airtime and CPU on quiet
+    stretches. Anything else is polled at the regular `rate`.
+
+    The effective number of polls per second is available as
+    :attr:`pollRate` and is updated about once a second.
+    """
+
+    def __init__(self, rate, idleRate=IDLE_RATE, idleAfter=IDLE_AFTER):
+        self.period = 1.0 / rate
+        self.idlePeriod = 1.0 / min(rate, idleRate)
+        self.idleAfter = idleAfter
+        self.repeats = 0
+        self.pollRate = 0.0
+        self.polls = 0
+        self.windowStart = time.monotonic()
+
+    def next(self, isTimer, isRepeat):
+        """Account for one poll result and return the delay in seconds."""
+        self.polls += 1
+        now = time.monotonic()
+        if now - self.windowStart >= 1.0:
+            self.pollRate = self.polls / (now - self.windowStart)
+            self.polls = 0
+            self.windowStart = now
+        if isTimer and not isRepeat:
+            self.repeats = 0
+            return 0.0
+        if isRepeat:
+            self.repeats += 1
+        else:
+            self.repeats = 0
+        if self.repeats >= self.idleAfter:
+            return self.idlePeriod
+        return self.period
+
+    def wake(self):
+        """Leave idle mode, e.g. because a key command was sent."""
+        self.repeats = 0
@@ -0,0 +1,98 @@
+""" Monotonic race time from the 32-bit millisecond clock of the Control Unit """
+
+# the CU counts ms in 32 bits, i.e. it wraps around after about 49.7 days
+CLOCK_RANGE = 2**32
+
+# a timestamp lower than the one before is a wrap around if it is within
+# this many ms of either end of the range, otherwise the CU was reset
+WRAP_WINDOW = 3600 * 1000
+
+
+class RaceClock:
+    """Turns the timestamps of the CU into race time that never goes back.
+
+    The CU clock wraps around at CLOCK_RANGE and starts from 0 again
+    whenever the CU is reset, e.g. by clearCU. Race time continues across
+    both: after a wrap around by the CLOCK_RANGE ms the CU skipped, after
+    a reset by the host time that passed since the last timestamp, or
+    right where it stopped if the host time is not known.
+
+    Given the host time every timestamp was received at, the clock also
+    fits race time as a linear function of host time. The fit is a
+    least squares line, updated in O(1) per timestamp with running means
+    and co-moments, so :meth:`drift` and :meth:`toHost` are available
+    at any time. :meth:`toHost` relates CU events to host side
+    measurements; it includes the mean delay of receiving an event.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start over, e.g. for a new race."""
+        self.base = 0
+        self.last = None
+        self.lastRace = None
+        self.lastHost = None
+        self.origin = None
+        self.count = 0
+        self.meanHost = 0.0
+        self.meanRace = 0.0
+        self.varHost = 0.0
+        self.covar = 0.0
+
+    def extend(self, timestamp, host=None):
+        """Race time in ms of the CU `timestamp` received at `host`.
+
+        `host` is in seconds of any host clock, the same one for all
+        calls, e.g. time.time().
+        """
+        if self.last is not None and timestamp < self.last:
+            if self.last >= CLOCK_RANGE - WRAP_WINDOW and timestamp < WRAP_WINDOW:
+                self.base += CLOCK_RANGE
+            else:
+                gap = 0
+                if host is not None and self.lastHost is not None:
+                    gap = max(0, round((host - self.lastHost) * 1000))
+                self.base = self.lastRace + gap - timestamp
+        race = self.base + timestamp
+        self.last = timestamp
+        self.lastRace = race
+        if host is not None:
+            self.lastHost = host
+            self.observe(host, race)
+        return race
+
+    def observe(self, host, race):
+        if self.origin is None:
+            self.origin = host
+        # ms since the first timestamp, which keeps the squares small
+        x = (host - self.origin) * 1000
+        self.count += 1
+        dx = x - self.meanHost
+        self.meanHost += dx / self.count
+        self.meanRace += (race - self.meanRace) / self.count
+        self.varHost += dx * (x - self.meanHost)
+        self.covar += dx * (race - self.meanRace)
+
+    def rate(self):
+        """ms of race time per ms of host time, None before the fit."""
+        if self.count < 2 or not self.varHost:
+            return None
+        return self.covar / self.varHost
+
+    def drift(self):
+        """How much faster the CU clock runs than the host's, e.g. 1e-5
+        for 10 ppm, None before the fit."""
+        rate = self.rate()
+        if rate is None:
+            return None
+        return rate - 1
+
+    def toHost(self, race):
+        """Host time in seconds at which race time `race` was received,
+        None without any host times."""
+        if self.origin is None:
+            return None
+        rate = self.rate() or 1.0
+        return self.origin + (self.meanHost + (race - self.meanRace) / rate) / 1000
@@ -0,0 +1,344 @@
+""" Race timing core of the race management system, without any GUI """
+
+import sys, time
+
+from laphistory import LapHistory
+from lapstats import LapStats, predictPositions
+from pollscheduler import PollScheduler
+from raceclock import RaceClock
+import racelog
+from sectortiming import FINISH_LINE, SectorTiming
+from standings import Standings
+
+# CU polls per second of the headless timing box
+POLL_RATE = 100
+
+
+def posgetter(driver):
+    return (-driver.lapcount, driver.time)
+
+
+class RaceDriver:
+    """Timing state of the car on one controller.
+
+    The record is touched for every CU event, so it has fixed slots
+    instead of an instance dict and is reset in place rather than
+    replaced, which keeps the objects the GUI is bound to.
+    """
+
+    __slots__ = (
+        "CtrlNum",
+        "name",
+        "lapcount",
+        "bestLapTime",
+        "lapTime",
+        "time",
+        "fuellevel",
+        "pitcount",
+        "pit",
+        "lapPits",
+        "laps",
+        "sectors",
+        "stats",
+    )
+
+    def __init__(self, driverNum):
+        self.sectors = SectorTiming()
+        self.stats = LapStats()
+        self.reset(driverNum)
+
+    def reset(self, driverNum):
+        self.CtrlNum = driverNum
+        self.name = "Driver " + str(driverNum)
+        self.lapTime = None
+        self.fuellevel = 15
+        self.pit = False
+        self.clear()
+
+    def clear(self):
+        """Forget the laps of the current session."""
+        self.lapcount = 0
+        self.bestLapTime = None
+        self.time = None
+        self.pitcount = 0
+        self.lapPits = 0
+        # a new history, the old one may still be part of the results
+        self.laps = LapHistory()
+        self.sectors.clear()
+        self.stats.clear()
+
+    def setCtrlNum(self, num):
+        self.CtrlNum = num
+
+    def newlap(self, timer):
+        if self.time is not None:
+            self.lapTime = timer.timestamp - self.time
+            if self.bestLapTime is None or self.lapTime < self.bestLapTime:
+                self.bestLapTime = self.lapTime
+            self.lapcount += 1
+            self.laps.append(
+                timer.timestamp,
+                self.lapTime,
+                self.sectors.lastLapSplits,
+                self.pitcount != self.lapPits,
+            )
+            self.stats.lap(self.lapTime, self.fuellevel, self.pitcount != self.lapPits)
+        self.time = timer.timestamp
+        self.lapPits = self.pitcount
+
+
+class RaceSession:
+    """Progression through Practice, Qualification and Race."""
+
+    def __init__(self):
+        self.amount = None
+        self.session = None
+        self.type = None
+        self.leaderboard = {}
+        self.sessionSteps = ["Practice", "Qualification", "Race"]
+
+    def setRace(self, raceDict):
+        self.leaderboard = {}
+        self.raceDict = raceDict
+        for stepIdx, step in enumerate(self.sessionSteps):
+            if step in raceDict:
+                self.type = raceDict[step]["mode"]
+                self.amount = int(raceDict[step]["amount"])
+                self.session = step
+                self.currentStep = stepIdx
+                break
+
+    def sessionOver(self):
+        for step in self.sessionSteps:
+            self.currentStep += 1
+            if len(self.sessionSteps) > self.currentStep:
+                if self.sessionSteps[self.currentStep] in self.raceDict:
+                    self.session = self.sessionSteps[self.currentStep]
+                    self.amount = int(
+                        self.raceDict[self.sessionSteps[self.currentStep]]["amount"]
+                    )
+                    self.type = self.raceDict[self.sessionSteps[self.currentStep]][
+                        "mode"
+                    ]
+                    break
+            else:
+                self.type = None
+                self.session = "Race Finished"
+
+    def saveSessionData(self, driverArr, start):
+        results = []
+        for driver in sorted(driverArr, key=posgetter):
+            results.append(
+                {
+                    "laps": driver.lapcount,
+                    "total": driver.time - start,
+                    "best": driver.bestLapTime,
+                    "pits": driver.pitcount,
+                    "name": driver.name,
+                    "history": driver.laps,
+                }
+            )
+            driver.clear()
+        self.leaderboard[self.sessionSteps[self.currentStep]] = results
+        return results
+
+
+class RaceEngine:
+    """Lap counting, standings, sessions and fuel/pit tracking.
+
+    The engine is fed with the Status and Timer objects read from the
+    CU and tells its subscribers about what happened:
+
+    - "lap" (driver, timer) after a driver crossed the start/finish line
+    - "sector" (driver, timer) after a driver passed a Check Lane
+    - "sessionOver" (session, results) when a session has been completed
+    - "raceOver" (leaderboard) after the last session of a race
+
+    Reacting to these, e.g. by stopping the CU or by showing the results,
+    is left to the subscribers.
+
+    Timer events are passed on with the timestamp of the CU replaced by
+    the race time of :attr:`clock`, which keeps counting across wrap
+    arounds and resets of the CU clock.
+
+    If :attr:`log` is set to a :class:`racelog.RaceLog` every event that
+    changes the race is written to it, and :meth:`replay` rebuilds the
+    race from such a log.
+    """
+
+    def __init__(self):
+        self.log = None
+        self.session = RaceSession()
+        self.subscribers = {
+            "lap": [],
+            "sector": [],
+            "sessionOver": [],
+            "raceOver": [],
+        }
+        self.drivers = [RaceDriver(num) for num in range(1, 9)]
+        self.standings = Standings(posgetter)
+        self.start = None
+        self.fuel = None
+        self.pit = None
+        self.clock = RaceClock()
+
+    def subscribe(self, event, callback):
+        self.subscribers[event].append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.subscribers[event]:
+            callback(*args)
+
+    def reset(self):
+        if self.log is not None:
+            self.log.reset()
+        self.start = None
+        self.fuel = None
+        self.pit = None
+        self.clock.reset()
+        for num, driver in enumerate(self.drivers, start=1):
+            driver.reset(num)
+        self.standings.clear()
+
+    def setDrivers(self, drivers):
+        """Use `drivers` in controller order, e.g. after reassigning them."""
+        self.drivers = drivers
+        # the next status has to be applied to all of them again
+        self.fuel = None
+        self.pit = None
+
+    def setRace(self, raceDict):
+        if self.log is not None:
+            self.log.race(raceDict)
+        for driver in self.drivers:
+            driver.clear()
+        self.standings.clear()
+        # the race starts with the first crossing after the setup
+        self.start = None
+        self.session.setRace(raceDict)
+
+    def handle_status(self, status):
+        if self.log is not None:
+            self.log.status(status)
+        # most status changes are only the start lights or a single fuel
+        # level, only go over the drivers for the vectors that changed
+        if status.fuel != self.fuel:
+            self.fuel = status.fuel
+            for driver, fuel in zip(self.drivers, status.fuel):
+                driver.fuellevel = fuel
+        if status.pit != self.pit:
+            self.pit = status.pit
+            for driver, pit in zip(self.drivers, status.pit):
+                if pit and not driver.pit:
+                    driver.pitcount += 1
+                driver.pit = pit
+
+    def handle_timer(self, timer, received=None):
+        """Count the lap of a Timer received at time.time() `received`."""
+        if self.log is not None:
+            self.log.timer(timer)
+        if received is None:
+            received = time.time()
+        timer = timer._replace(timestamp=self.clock.extend(timer.timestamp, received))
+        driver = self.drivers[timer.address]
+        driver.sectors.passed(timer.sector, timer.timestamp)
+        if timer.sector != FINISH_LINE:
+            # Check Lanes only split the lap
+            self.emit("sector", driver, timer)
+            return
+        driver.newlap(timer)
+        self.standings.update(driver)
+        if self.start is None:
+            self.start = timer.timestamp
+        predictPositions(self.standings.order, self.session, self.start)
+        self.emit("lap", driver, timer)
+        self.checkSession()
+
+    def replay(self, records, started=None):
+        """Feed the records of a race log into the engine again.
+
+        `started` is the time.time() the log was started at, see
+        :func:`racelog.logStarted`. Returns the number of status and
+        timer records since the last reset, i.e. 0 if there was no race
+        to resume. Subscribers are notified as if the race was live.
+        """
+        count = 0
+        for kind, ms, data in records:
+            if kind == racelog.KIND_STATUS:
+                self.handle_status(data)
+                count += 1
+            elif kind == racelog.KIND_TIMER:
+                self.handle_timer(
+                    data, None if started is None else started + ms / 1000
+                )
+                count += 1
+            elif kind == racelog.KIND_RACE:
+                self.setRace(data)
+            elif kind == racelog.KIND_RESET:
+                self.reset()
+                count = 0
+        return count
+
+    def leader(self):
+        if self.standings.order:
+            return self.standings.order[0]
+        return None
+
+    def checkSession(self):
+        leader = self.leader()
+        if leader is None or self.session.session is None or self.start is None:
+            return
+        if self.session.type == "Laps":
+            if leader.lapcount > self.session.amount:
+                self.stopSession()
+        elif self.session.type == "Timed":
+            if leader.time - self.start > self.session.amount * 60000:
+                self.stopSession()
+
+    def stopSession(self):
+        session = self.session.session
+        if self.log is not None:
+            self.log.session()
+        results = self.session.saveSessionData(self.standings.order, self.start)
+        self.standings.clear()
+        # race time goes on across sessions, the next one starts with its
+        # first crossing
+        self.start = None
+        self.emit("sessionOver", session, results)
+        self.session.sessionOver()
+        if self.session.type is None:
+            self.session.session = None
+            self.emit("raceOver", self.session.leaderboard)
+
+
+def main(device):
+    """Headless timing box printing every lap to stdout."""
+    from carreralib import ControlUnit
+
+    cu = ControlUnit(device, timeout=1.0)
+    engine = RaceEngine()
+
+    def printLap(driver, timer):
+        if driver.lapTime is not None:
+            print(
+                "%s lap %d %d.%03d"
+                % (driver.name, driver.lapcount, *divmod(driver.lapTime, 1000))
+            )
+
+    engine.subscribe("lap", printLap)
+    scheduler = PollScheduler(POLL_RATE)
+    last = None
+    while True:
+        data = cu.poll()
+        time.sleep(scheduler.next(isinstance(data, ControlUnit.Timer), data == last))
+        if data == last:
+            continue
+        elif isinstance(data, ControlUnit.Status):
+            engine.handle_status(data)
+        elif isinstance(data, ControlUnit.Timer):
+            engine.handle_timer(data)
+        last = data
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,343 @@
+""" Append-only binary log of the CU events of a race """
+
+import functools, os, queue, struct, threading, time
+
+from raceclock import CLOCK_RANGE, WRAP_WINDOW
+
+# file the GUIs log to and replay from on start
+LOG_FILE = "race.rmslog"
+
+# the writer syncs the log to disk at most this often, in ms
+FSYNC_INTERVAL = 200
+
+# number of records that may be waiting for the writer thread
+QUEUE_SIZE = 4096
+
+MAGIC = b"RMSLOG1\0"
+
+# every record has the same size: kind and ms since the log was started,
+# followed by the payload of the kind, padded with zeros
+RECORD_SIZE = 20
+HEADER = struct.Struct("<8sQ4x")
+STATUS = struct.Struct("<BI8sBBBB3x")
+TIMER = struct.Struct("<BIBIB9x")
+RACE = struct.Struct("<BIBIBIBI")
+RESET = struct.Struct("<BI15x")
+
+# record kinds
+KIND_STATUS = 1
+KIND_TIMER = 2
+KIND_RACE = 3
+KIND_RESET = 4
+# the engine ended a session, replaying the laps ends it again, the record
+# only marks where the next session starts
+KIND_SESSION = 5
+
+
+@functools.lru_cache(maxsize=None)
+def recordDtype():
+    """All record kinds in one NumPy dtype.
+
+    The fields of a kind overlap those of the others and only make sense
+    for records of that kind; the names are the fields of
+    ControlUnit.Status and ControlUnit.Timer. NumPy takes longer to
+    import than the rms to start, so it is only imported here.
+    """
+    import numpy
+
+    return numpy.dtype(
+        {
+            "names": [
+                "kind",
+                "ms",
+                "fuel",
+                "start",
+                "mode",
+                "pit",
+                "display",
+                "address",
+                "timestamp",
+                "sector",
+            ],
+            "formats": [
+                "u1",
+                "<u4",
+                ("u1", 8),
+                "u1",
+                "u1",
+                "u1",
+                "u1",
+                "u1",
+                "<u4",
+                "u1",
+            ],
+            "offsets": [0, 1, 5, 13, 14, 15, 16, 5, 6, 10],
+            "itemsize": RECORD_SIZE,
+        }
+    )
+
+
+SESSION_STEPS = ("Practice", "Qualification", "Race")
+SESSION_MODES = (None, "Open", "Timed", "Laps")
+
+
+def packRecord(kind, ms, data):
+    if kind == KIND_STATUS:
+        pits = 0
+        for idx, pit in enumerate(data.pit):
+            if pit:
+                pits |= 1 << idx
+        return STATUS.pack(
+            kind, ms, bytes(data.fuel), data.start, data.mode, pits, data.display
+        )
+    elif kind == KIND_TIMER:
+        return TIMER.pack(kind, ms, data.address, data.timestamp, data.sector)
+    elif kind == KIND_RACE:
+        steps = []
+        for step in SESSION_STEPS:
+            if step in data:
+                steps.append(SESSION_MODES.index(data[step]["mode"]))
+                steps.append(int(data[step]["amount"] or 0))
+            else:
+                steps.extend((0, 0))
+        return RACE.pack(kind, ms, *steps)
+    else:
+        # reset and session records carry no data
+        return RESET.pack(kind, ms)
+
+
+def unpackRecord(buf, Status, Timer):
+    """Decode one record into (kind, ms, data)."""
+    kind = buf[0]
+    if kind == KIND_STATUS:
+        kind, ms, fuel, start, mode, pits, display = STATUS.unpack(buf)
+        pit = tuple(bool(pits & (1 << idx)) for idx in range(len(fuel)))
+        return kind, ms, Status(tuple(fuel), start, mode, pit, display)
+    elif kind == KIND_TIMER:
+        kind, ms, address, timestamp, sector = TIMER.unpack(buf)
+        return kind, ms, Timer(address, timestamp, sector)
+    elif kind == KIND_RACE:
+        kind, ms, *steps = RACE.unpack(buf)
+        raceDict = {}
+        for idx, step in enumerate(SESSION_STEPS):
+            mode, amount = steps[2 * idx : 2 * idx + 2]
+            if mode:
+                raceDict[step] = {"mode": SESSION_MODES[mode], "amount": str(amount)}
+        return kind, ms, raceDict
+    elif kind in (KIND_RESET, KIND_SESSION):
+        kind, ms = RESET.unpack(buf)[:2]
+        return kind, ms, None
+    raise ValueError("Unknown record kind %d" % kind)
+
+
+def readLog(path, Status, Timer):
+    """Yield the (kind, ms, data) records of the log at `path`.
+
+    Status and Timer are the classes the CU events are decoded into. A
+    record that was only partly written when the program died is
+    ignored, so is a log that does not exist.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            return
+        while True:
+            buf = f.read(RECORD_SIZE)
+            if len(buf) < RECORD_SIZE:
+                return
+            yield unpackRecord(buf, Status, Timer)
+
+
+def logStarted(path):
+    """time.time() at which the log at `path` was started, or None."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        return None
+    return HEADER.unpack(header)[1] / 1000
+
+
+def mapLog(path):
+    """Memory-map the records of the log at `path` as NumPy structured array.
+
+    Nothing is read until the records are accessed, so even logs of
+    millions of records open instantly. The fields are those of
+    recordDtype(), "pit" is a bit mask with bit n set if car n is in the
+    pit lane. The records of a kind are selected with e.g.
+    ``records[records["kind"] == KIND_TIMER]``.
+    """
+    import numpy
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if HEADER.unpack(f.read(HEADER.size))[0] != MAGIC:
+            raise ValueError("%s is not a race log" % path)
+    count = (size - HEADER.size) // RECORD_SIZE
+    if count == 0:
+        return numpy.zeros(0, dtype=recordDtype())
+    return numpy.memmap(
+        path, dtype=recordDtype(), mode="r", offset=HEADER.size, shape=(count,)
+    )
+
+
+def standingsAt(records, ms):
+    """Standings `ms` after the log was started, computed from `records`.
+
+    Only the laps of the session running at `ms` count, i.e. those since
+    the last race setup, end of a session or reset. Returns the arrays
+    (address, laps, timestamp) in race order, with the race time of the
+    last time each car crossed the line.
+    """
+    import numpy
+
+    records = records[records["ms"] <= ms]
+    starts = numpy.flatnonzero(
+        numpy.isin(records["kind"], (KIND_RACE, KIND_SESSION, KIND_RESET))
+    )
+    if len(starts):
+        records = records[starts[-1] :]
+    timers = records[records["kind"] == KIND_TIMER]
+    timestamps = raceTime(timers["timestamp"], timers["ms"])
+    # only the start/finish line counts laps, not the Check Lanes
+    finish = timers["sector"] == 1
+    address = timers["address"][finish].astype(numpy.intp)
+    crossings = numpy.bincount(address, minlength=8)
+    last = numpy.zeros(len(crossings), dtype=numpy.int64)
+    numpy.maximum.at(last, address, timestamps[finish])
+    # the first crossing only starts the timing of a car
+    laps = numpy.maximum(crossings - 1, 0)
+    order = numpy.lexsort((last, -laps))
+    order = order[crossings[order] > 0]
+    return order, laps[order], last[order]
+
+
+def raceTime(timestamps, ms):
+    """CU `timestamps` received at `ms` as race time, like RaceClock.
+
+    Where the CU clock goes back it wrapped around or was reset, e.g. by
+    clearCU, and race time goes on by the time between the two records.
+    """
+    import numpy
+
+    timestamps = timestamps.astype(numpy.int64)
+    if not len(timestamps):
+        return timestamps
+    steps = numpy.diff(timestamps)
+    back = steps < 0
+    wrapped = (
+        back
+        & (timestamps[:-1] >= CLOCK_RANGE - WRAP_WINDOW)
+        & (timestamps[1:] < WRAP_WINDOW)
+    )
+    steps = numpy.where(back, numpy.diff(ms.astype(numpy.int64)), steps)
+    steps = numpy.where(wrapped, timestamps[1:] + CLOCK_RANGE - timestamps[:-1], steps)
+    return timestamps[0] + numpy.concatenate(([0], numpy.cumsum(steps)))
+
+
+class RaceLog:
+    """Writes the CU events of a race to an append-only log.
+
+    The methods called from the poll loop only take a timestamp and put
+    the event into a bounded queue, packing, writing and syncing is done
+    by a background thread. The log is synced at most every
+    `fsyncInterval` ms, so a crash loses at most the events of that
+    interval. If the writer cannot keep up the events are dropped and
+    counted in :attr:`dropped` rather than blocking the poll loop, only
+    a reset waits for the writer.
+
+    A reset starts the log from scratch, everything before it is no
+    longer needed to rebuild the race.
+    """
+
+    def __init__(
+        self, path=LOG_FILE, fsyncInterval=FSYNC_INTERVAL, queueSize=QUEUE_SIZE
+    ):
+        self.path = path
+        self.fsyncInterval = fsyncInterval / 1000
+        self.queue = queue.Queue(queueSize)
+        self.dropped = 0
+        self.file = open(path, "ab")
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < HEADER.size:
+            self.started = time.time()
+            self.writeHeader(self.started)
+        else:
+            with open(path, "rb") as f:
+                self.started = HEADER.unpack(f.read(HEADER.size))[1] / 1000
+            # drop a record torn by a crash, so the next one is aligned
+            self.file.truncate(size - (size - HEADER.size) % RECORD_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def writeHeader(self, started):
+        self.file.truncate(0)
+        self.file.write(HEADER.pack(MAGIC, int(started * 1000)))
+
+    def put(self, kind, data):
+        ms = int((time.time() - self.started) * 1000)
+        try:
+            self.queue.put_nowait((kind, ms, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def status(self, status):
+        self.put(KIND_STATUS, status)
+
+    def timer(self, timer):
+        self.put(KIND_TIMER, timer)
+
+    def race(self, raceDict):
+        self.put(KIND_RACE, raceDict)
+
+    def session(self):
+        self.put(KIND_SESSION, None)
+
+    def reset(self):
+        started = time.time()
+        # the header and the times of all later records depend on the reset
+        # record, so it waits for room in the queue instead of being dropped
+        self.queue.put((KIND_RESET, 0, started))
+        self.started = started
+
+    def close(self):
+        """Write and sync everything still queued and stop the writer."""
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def run(self):
+        lastSync = time.monotonic()
+        dirty = False
+        while True:
+            timeout = None
+            if dirty:
+                timeout = max(0, lastSync + self.fsyncInterval - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = ()
+            if record is None:
+                break
+            if record:
+                kind, ms, data = record
+                if kind == KIND_RESET:
+                    self.writeHeader(data)
+                self.file.write(packRecord(kind, ms, data))
+                dirty = True
+            if dirty and time.monotonic() - lastSync >= self.fsyncInterval:
+                self.sync()
+                lastSync = time.monotonic()
+                dirty = False
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
@@ -0,0 +1,99 @@
+""" Stand-in for the Control Unit replaying a recorded race log """
+
+import time
+
+from carreralib import ControlUnit
+
+import racelog
+
+# prefix of the device argument of rms.py that selects a replay
+DEVICE_PREFIX = "replay:"
+
+
+class ReplayControlUnit:
+    """Replays the CU events of a race log through the ControlUnit API.
+
+    poll() returns the recorded Status and Timer events in their order,
+    at the recorded pace divided by `speed`. Between two events the last
+    status is repeated, as a real CU would. A `speed` of 0 returns the
+    next event on every poll, as fast as the caller polls, which makes
+    a run independent of any timing. Commands are accepted and ignored.
+
+    The log is read completely when the replay is created, later writes
+    to it do not change the replay.
+    """
+
+    Status = ControlUnit.Status
+    Timer = ControlUnit.Timer
+
+    def __init__(self, path, speed=1.0):
+        with open(path, "rb") as f:
+            header = f.read(racelog.HEADER.size)
+            if racelog.HEADER.unpack(header)[0] != racelog.MAGIC:
+                raise ValueError("%s is not a race log" % path)
+            self.data = f.read()
+        self.count = len(self.data) // racelog.RECORD_SIZE
+        self.speed = speed
+        self.index = 0
+        self.status = ControlUnit.Status((0,) * 8, 0, 0, (False,) * 8, 0)
+        self.started = None
+        self.firstMs = None
+
+    @classmethod
+    def fromDevice(cls, device):
+        """Create the replay for a device argument like replay:PATH@SPEED.
+
+        SPEED is a factor of the recorded pace or "max", default is 1.
+        """
+        path, _, speed = device[len(DEVICE_PREFIX) :].partition("@")
+        if speed == "max":
+            return cls(path, 0)
+        return cls(path, float(speed or 1))
+
+    def next(self):
+        # decode records on demand, only CU events are replayed
+        while self.index < self.count:
+            offset = self.index * racelog.RECORD_SIZE
+            kind, ms, data = racelog.unpackRecord(
+                self.data[offset : offset + racelog.RECORD_SIZE],
+                ControlUnit.Status,
+                ControlUnit.Timer,
+            )
+            if kind in (racelog.KIND_STATUS, racelog.KIND_TIMER):
+                return ms, data
+            self.index += 1
+        return None, None
+
+    def poll(self):
+        ms, data = self.next()
+        if data is None:
+            return self.status
+        if self.speed:
+            now = time.monotonic()
+            if self.started is None:
+                self.started = now
+                self.firstMs = ms
+            if (ms - self.firstMs) / self.speed > (now - self.started) * 1000:
+                return self.status
+        self.index += 1
+        if isinstance(data, ControlUnit.Status):
+            self.status = data
+        return data
+
+    def request(self, buf, maxlength=None):
+        return None
+
+    def start(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def clrpos(self):
+        pass
+
+    def version(self):
+        return "replay"
+
+    def close(self):
+        pass
@@ -8,7 +8,6 @@ from PyQt5.QtWidgets import (
     QApplication,
     QWidget,
     QLCDNumber,
-    QProgressBar,
     QPushButton,
     QLabel,
     QFrame,
@@ -34,9 +33,13 @@ from PyQt5.QtCore import (
     QTimer,
     QTime,
     QObject,
+    QThread,
     QByteArray,
     pyqtProperty,
+    pyqtSignal,
     QPropertyAnimation,
+    QRect,
+    QSize,
     Qt,
 )
 
@@ -46,15 +49,32 @@ except ImportError:
     QBluetoothDeviceDiscoveryAgent = None
 
 
-from PyQt5.QtGui import QKeySequence, QFont, QPainter, QPalette, QColor
+from PyQt5.QtGui import (
+    QKeySequence,
+    QFont,
+    QPainter,
+    QPalette,
+    QColor,
+    QLinearGradient,
+)
+
+from carreralib import ControlUnit, protocol
 
-from carreralib import ControlUnit
+from pollscheduler import PollScheduler
+from raceengine import RaceEngine
+from racelog import RaceLog, logStarted, readLog, LOG_FILE
+import lapstats, latency, metrics, transport
 
-import sys, os
+import sys, os, asyncio, errno, queue, time
 
+# default number of CU polls per second, can be overridden on the command line
+POLL_RATE = 100
 
-def posgetter(driver):
-    return (-driver.lapcount, driver.time)
+USAGE = "usage: python3 rms.py [<CU BT Address> [<polls per second>]]"
+
+# number of display updates per second, independent of the CU event rate,
+# can be overridden with the environment variable RMS_REFRESH_RATE
+REFRESH_RATE = 30
 
 
 def formattime(time, longfmt=False):
@@ -120,6 +140,67 @@ class StartLight(QWidget):
         painter.drawEllipse(0, 0, self.width(), self.height())
 
 
+def fuelGradientStops(level):
+    # same colors as the former QProgressBar style sheet, the red part grows
+    # as the fuel level drops
+    stops = [
+        (0.0, QColor("#00AA00")),
+        (0.92 - 1 / level, QColor("#22FF22")),
+        (0.921 - 1 / level, QColor("#22FF22")),
+        (1.001 - 1 / level, QColor("red")),
+        (1.0, QColor("#550000")),
+    ]
+    return [(min(max(stop, 0.0), 1.0), color) for stop, color in stops]
+
+
+class FuelGauge(QWidget):
+    """Fuel level bar which paints its gradient itself.
+
+    The CU only reports 16 fuel levels, so the gradient stops for every
+    level are computed once and a repaint is only scheduled when the
+    level changes.
+    """
+
+    MAXIMUM = 15
+    STOPS = [None] + [fuelGradientStops(level) for level in range(1, MAXIMUM + 1)]
+
+    def __init__(self):
+        super().__init__()
+        self.level = 0
+
+    def sizeHint(self):
+        return QSize(117, 39)
+
+    def minimumSizeHint(self):
+        return QSize(117, 23)
+
+    def value(self):
+        return self.level
+
+    def setValue(self, level):
+        if level != self.level:
+            self.level = level
+            self.update()
+
+    def paintEvent(self, e):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(Qt.black)
+        painter.drawRoundedRect(self.rect(), 10, 10)
+        inner = self.rect().adjusted(5, 5, -5, -5)
+        if self.level > 0:
+            chunk = QRect(inner)
+            chunk.setWidth(inner.width() * self.level // self.MAXIMUM)
+            gradient = QLinearGradient(chunk.topRight(), chunk.topLeft())
+            gradient.setStops(self.STOPS[self.level])
+            painter.fillRect(chunk, gradient)
+        painter.setPen(Qt.white)
+        painter.drawText(
+            inner, Qt.AlignCenter, "%d%%" % (self.level * 100 // self.MAXIMUM)
+        )
+
+
 class StartLights(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -141,12 +222,168 @@ class StartLights(QWidget):
         self.spacekey = QShortcut(QKeySequence("Space"), self)
 
 
+class CUPoller(QObject):
+    """Polls the Control Unit in a worker thread.
+
+    The worker runs an asyncio event loop, which talks to the CU through
+    a :class:`transport.Transport`, so all kinds of CU connections are
+    polled the same way. The poll interval is chosen by a PollScheduler:
+    back-to-back while timer events are pending, `rate` polls per second
+    normally and slower once the CU keeps reporting the same status.
+    Decoded Status and Timer objects are handed to the GUI thread via
+    queued signals. Key presses and other requests from the GUI are
+    queued and executed by the worker between two polls, so the CU
+    connection is only ever used by one thread.
+    """
+
+    statusReceived = pyqtSignal(object)
+    timerReceived = pyqtSignal(object)
+    pollRateChanged = pyqtSignal(float)
+    versionReceived = pyqtSignal(object)
+
+    def __init__(self, transport, rate=POLL_RATE):
+        super().__init__()
+        self.transport = transport
+        self.rate = rate
+        self.scheduler = PollScheduler(rate)
+        self.commands = queue.Queue()
+        self.shutdown = False
+        # event loop of the worker and the event waking it up for commands
+        self.loop = None
+        self.wakeup = None
+        if metrics.registry is not None:
+            metrics.registry.gauge(
+                "rms_command_queue_depth",
+                "Commands waiting to be sent to the CU",
+                self.commands.qsize,
+            )
+
+    def run(self):
+        try:
+            asyncio.run(self.pollLoop())
+        finally:
+            self.loop = None
+        self.thread().quit()
+
+    async def pollLoop(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        try:
+            await self.pollEvents()
+        finally:
+            # the transport may belong to this event loop
+            self.transport.close()
+
+    async def pollEvents(self):
+        self.versionReceived.emit(await self.transport.version())
+        last = None
+        pollRate = 0.0
+        nextPoll = time.monotonic()
+        while not self.shutdown:
+            try:
+                await self.runCommands(nextPoll - time.monotonic())
+                if self.shutdown:
+                    break
+                pollStart = time.monotonic()
+                try:
+                    data = await self.transport.poll()
+                except protocol.ChecksumError:
+                    continue
+                nextPoll = pollStart + self.scheduler.next(
+                    isinstance(data, ControlUnit.Timer), data == last
+                )
+                if self.scheduler.pollRate != pollRate:
+                    pollRate = self.scheduler.pollRate
+                    self.pollRateChanged.emit(pollRate)
+                if metrics.registry is not None:
+                    metrics.registry.inc("rms_polls_total")
+                    if data == last:
+                        metrics.registry.inc("rms_duplicate_frames_total")
+                    elif isinstance(data, ControlUnit.Timer):
+                        metrics.registry.inc('rms_events_total{kind="timer"}')
+                    else:
+                        metrics.registry.inc('rms_events_total{kind="status"}')
+                if data == last:
+                    continue
+                elif isinstance(data, ControlUnit.Status):
+                    self.statusReceived.emit(data)
+                elif isinstance(data, ControlUnit.Timer):
+                    if latency.tracer is not None:
+                        # the transport decodes the timer within poll(), so
+                        # there is no separate decode stage
+                        latency.tracer.receive(data)
+                    self.timerReceived.emit(data)
+                else:
+                    pass
+                last = data
+
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    async def runCommands(self, timeout):
+        # wait for the next poll slot, but wake up early for queued requests
+        while True:
+            self.wakeup.clear()
+            try:
+                command, args = self.commands.get_nowait()
+            except queue.Empty:
+                if timeout <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return
+                timeout = 0
+                continue
+            await command(*args)
+            self.scheduler.wake()
+            timeout = 0
+
+    def put(self, command, *args):
+        self.commands.put((command, args))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def stop(self):
+        self.shutdown = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def request(self, buf):
+        self.put(self.transport.request, buf)
+
+    def start(self):
+        self.put(self.transport.start)
+
+    def reset(self):
+        self.put(self.transport.reset)
+
+    def clear(self):
+        self.put(self.transport.clear)
+
+
 class Rms(QMainWindow):
     def __init__(self):
         super().__init__()
 
-        self.shutdown = False
-        if len(sys.argv) == 2:
+        try:
+            self.refreshRate = int(os.environ.get("RMS_REFRESH_RATE", REFRESH_RATE))
+        except ValueError:
+            self.refreshRate = 0
+        if self.refreshRate <= 0:
+            sys.exit("the refresh rate RMS_REFRESH_RATE must be at least 1 per second")
+        if len(sys.argv) > 3:
+            sys.exit(USAGE)
+        self.pollRate = POLL_RATE
+        if len(sys.argv) == 3:
+            try:
+                self.pollRate = int(sys.argv[2])
+            except ValueError:
+                self.pollRate = 0
+            if self.pollRate <= 0:
+                sys.exit("the poll rate must be at least 1 per second\n" + USAGE)
+        if len(sys.argv) >= 2:
             self.startRMS(sys.argv[1])
         else:
             self.btDialog = BtSelect()
@@ -166,9 +403,14 @@ class Rms(QMainWindow):
                 sys.exit()
 
     def closeEvent(self, event):
-        self.shutdown = True
-        self.cu.close()
+        self.poller.stop()
+        self.pollThread.wait()
+        if self.rmsframe.engine.log is not None:
+            self.rmsframe.engine.log.close()
+        if latency.tracer is not None:
+            latency.tracer.export()
         event.accept()
+        app.quit()
 
     def discoverCU(self):
         self.btDialog.scanBtn.setEnabled(False)
@@ -194,43 +436,43 @@ class Rms(QMainWindow):
         sys.exit()
 
     def startRMS(self, device):
-        self.cu = ControlUnit(device, timeout=1.0)
-        self.cuVersion = self.cu.version()
+        if transport.isLocal(device):
+            # a replay neither resumes nor overwrites the log of a real race
+            self.logFile = None
+        else:
+            self.logFile = LOG_FILE
+        self.cu = transport.openTransport(device)
+        self.poller = CUPoller(self.cu, self.pollRate)
+        self.pollThread = QThread()
+        self.poller.moveToThread(self.pollThread)
+        self.pollThread.started.connect(self.poller.run)
+        self.poller.statusReceived.connect(self.handle_status, Qt.QueuedConnection)
+        self.poller.timerReceived.connect(self.handle_timer, Qt.QueuedConnection)
+        self.poller.pollRateChanged.connect(self.showPollRate, Qt.QueuedConnection)
+        self.poller.versionReceived.connect(self.setVersion, Qt.QueuedConnection)
         self.initUI()
 
     def initUI(self):
         self.startLights = StartLights()
         rectDesktop = app.desktop().availableGeometry()
         self.startLights.resize(rectDesktop.width() // 2, rectDesktop.width() // 10)
-        self.setWindowTitle(
-            "Race Management System V1.0   CU Version:" + str(self.cuVersion)
+        self.setWindowTitle("Race Management System V1.0")
+        self.rmsframe = RmsFrame(
+            self.poller, refreshRate=self.refreshRate, logFile=self.logFile
         )
-        self.rmsframe = RmsFrame(self.cu)
         self.startLights.spacekey.activated.connect(self.rmsframe.racestart)
         self.setCentralWidget(self.rmsframe)
 
     def run(self):
-        last = None
-        while True:
-            if self.shutdown:
-                break
-            try:
-                data = self.cu.poll()
-                app.processEvents()
-                if data == last:
-                    continue
-                elif isinstance(data, ControlUnit.Status):
-                    self.handle_status(data)
-                elif isinstance(data, ControlUnit.Timer):
-                    self.handle_timer(data)
-                else:
-                    pass
-                last = data
+        self.pollThread.start()
 
-            except IOError as e:
-                if e.errno != errno.EINTR:
-                    raise
-        sys.exit()
+    def setVersion(self, version):
+        self.setWindowTitle("Race Management System V1.0   CU Version:" + str(version))
+
+    def showPollRate(self, rate):
+        self.statusBar().showMessage("Poll rate: %.0f Hz" % rate)
+        if metrics.registry is not None:
+            metrics.registry.set("rms_poll_rate_hz", rate)
 
     def handle_status(self, status):
         if status.start > 0 and status.start <= 7:
@@ -254,22 +496,19 @@ class Rms(QMainWindow):
                 self.startLights.lightFive.setOn(False)
         else:
             self.startLights.hide()
-        for driver, fuel in zip(self.rmsframe.driverArr, status.fuel):
-            driver.fuellevel = fuel
-        for driver, pit in zip(self.rmsframe.driverArr, status.pit):
-            if pit and not driver.pit:
-                driver.pitcount += 1
-            driver.pit = pit
+        self.rmsframe.engine.handle_status(status)
         self.binmode = "{0:04b}".format(status.mode)
-        self.rmsframe.updateDisplay(self.binmode)
+        self.rmsframe.binMode = self.binmode
+        self.rmsframe.displayDirty = True
         self.status = status
 
     def handle_timer(self, timer):
-        driver = self.rmsframe.driverArr[timer.address]
-        driver.newlap(timer)
-        if self.rmsframe.start is None:
-            self.rmsframe.start = timer.timestamp
-        self.rmsframe.updateDisplay(None)
+        if latency.tracer is not None:
+            latency.tracer.stage(timer, "handle")
+        self.rmsframe.engine.handle_timer(timer)
+        if latency.tracer is not None:
+            latency.tracer.stage(timer, "model")
+        self.rmsframe.displayDirty = True
 
 
 class CtrlDialog(QDialog):
@@ -438,12 +677,56 @@ class RaceModeDialog(QDialog):
 
 
 class RmsFrame(QFrame):
-    def __init__(self, cu):
+    def __init__(self, cu, refreshRate=REFRESH_RATE, logFile=LOG_FILE):
         super().__init__()
         self.cu = cu
-        self.session = RaceSession()
-        self.resetRMS()
+        self.engine = RaceEngine()
+        # optional columns with the rolling lap statistics
+        self.statsColumns = lapstats.enabledColumns()
+        # continue the race of the last run if it did not end with a reset,
+        # e.g. because of a crash
+        resumed = 0
+        if logFile is not None:
+            resumed = self.engine.replay(
+                readLog(logFile, ControlUnit.Status, ControlUnit.Timer),
+                logStarted(logFile),
+            )
+        self.engine.subscribe("sessionOver", self.sessionOver)
+        self.engine.subscribe("raceOver", self.showLeaderboard)
+        self.session = self.engine.session
+        # the widgets of the driver grid rows are created once and stay bound
+        # to the same RaceDriver, a reset only clears what they show
+        self.driverArr = [RmsDriver(driver) for driver in self.engine.drivers]
+        for row, driver in enumerate(self.driverArr, start=1):
+            driver.getNameBtn().clicked.connect(
+                lambda _, row=row: self.changeDriver(
+                    self.driverBtn[row], self.driverObj[row]
+                )
+            )
+        if logFile is not None:
+            self.engine.log = RaceLog(logFile)
+        if resumed:
+            # the CU clock must keep running for the replayed lap times
+            self.viewModel = {}
+        else:
+            # starts the log afresh as well
+            self.resetRMS()
+        if self.engine.log is not None and metrics.registry is not None:
+            metrics.registry.gauge(
+                "rms_racelog_dropped",
+                "Events the race log could not keep up with",
+                lambda: self.engine.log.dropped,
+            )
         self.buildframe()
+        # CU events only update the drivers, the display follows at a fixed
+        # rate with whatever the latest state is
+        self.binMode = None
+        self.displayDirty = bool(resumed)
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.timeout.connect(self.refreshDisplay)
+        self.refreshTimer.start(1000 // refreshRate)
+        if latency.tracer is not None:
+            self.latencyOverlay = LatencyOverlay(self, latency.tracer)
         self.driverBtn = {}
         self.driverObj = {}
         self.lapcount = {}
@@ -452,6 +735,7 @@ class RmsFrame(QFrame):
         self.bestlaptime = {}
         self.fuelbar = {}
         self.pits = {}
+        self.stats = {}
 
     #        QBAcolor = QByteArray()
     #        QBAcolor.append('color')
@@ -571,7 +855,7 @@ class RmsFrame(QFrame):
             "Best Lap",
             "Fuel",
             "Pits",
-        ]
+        ] + [header for key, header in self.statsColumns]
         for index, label in enumerate(self.labelArr):
             self.headerLabel = QLabel(label)
             self.headerLabel.setFont(self.headerFont)
@@ -583,24 +867,24 @@ class RmsFrame(QFrame):
         self.mainLayout.setColumnStretch(5, 3)
         self.mainLayout.setColumnStretch(6, 2)
         self.mainLayout.setColumnStretch(7, 1)
+        for column in range(len(self.statsColumns)):
+            self.mainLayout.setColumnStretch(8 + column, 2)
         return self.mainLayout
 
     def openCtrlDialog(self):
-        self.ctrlDialog = CtrlDialog(self.driverArr)
+        self.ctrlDialog = CtrlDialog(self.engine.drivers)
         if self.ctrlDialog.exec_():
-            self.driverArr = self.ctrlDialog.newDriverArr
+            self.engine.setDrivers(self.ctrlDialog.newDriverArr)
+            self.viewModel.clear()
+            self.displayDirty = True
 
     def openRaceDlg(self):
         self.setupRaceDlg = RaceModeDialog()
         self.session.session = None
         self.session.type = None
         if self.setupRaceDlg.exec_():
-            for driver in self.driverArr:
-                driver.bestLapTime = None
-                driver.time = None
-                driver.lapcount = 0
-                driver.pitcount = 0
-            self.session.setRace(self.setupRaceDlg.getRaceModeInfo())
+            self.viewModel.clear()
+            self.engine.setRace(self.setupRaceDlg.getRaceModeInfo())
             self.racemode.setText(
                 self.session.session
                 + " "
@@ -649,12 +933,7 @@ class RmsFrame(QFrame):
             QSizePolicy.Preferred, QSizePolicy.Expanding
         )
         self.mainLayout.addWidget(self.driverBtn[driverRow], driverRow, 1)
-        self.driverObj[driverRow] = driver
-        self.driverBtn[driverRow].clicked.connect(
-            lambda: self.changeDriver(
-                self.driverBtn[driverRow], self.driverObj[driverRow]
-            )
-        )
+        self.driverObj[driverRow] = driver.driver
         self.lapcount[driverRow] = driver.getLapCountLCD()
         self.lapcount[driverRow].setSizePolicy(
             QSizePolicy.Preferred, QSizePolicy.Expanding
@@ -690,6 +969,17 @@ class RmsFrame(QFrame):
         self.pits[driverRow] = driver.getPits()
         self.pits[driverRow].setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
         self.mainLayout.addWidget(self.pits[driverRow], driverRow, 7)
+        self.stats[driverRow] = {}
+        for column, (key, header) in enumerate(self.statsColumns, start=8):
+            label = QLabel("-")
+            label.setStyleSheet(
+                "QLabel{ border-radius: 10px; border-color: black; border: 5px solid black; background-color: white}"
+            )
+            label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
+            label.setFont(self.totalFont)
+            label.setAlignment(Qt.AlignCenter)
+            self.stats[driverRow][key] = label
+            self.mainLayout.addWidget(label, driverRow, column)
 
     def racestart(self):
         self.cu.start()
@@ -698,20 +988,27 @@ class RmsFrame(QFrame):
     #        self.mainLayout.itemAtPosition(1, 5).widget().setPits('Track')
 
     def resetRMS(self):
-        if hasattr(self, "driverArr"):
-            for driverObj in self.driverArr:
-                driverObj.deleteLater()
-        self.start = None
-        self.driverArr = [RmsDriver(num) for num in range(1, 9)]
+        self.engine.reset()
+        for driverObj in self.driverArr:
+            driverObj.refresh()
+        # last value shown in every cell of the driver grid by (row, column)
+        self.viewModel = {}
 
         self.clearCU()
 
         if hasattr(self, "mainLayout"):
+            driverWidgets = set()
+            for driverObj in self.driverArr:
+                driverWidgets.update(driverObj.getWidgets())
             while True:
                 widgetToRemove = self.mainLayout.takeAt(0)
                 if widgetToRemove == None:
                     break
-                widgetToRemove.widget().deleteLater()
+                if widgetToRemove.widget() in driverWidgets:
+                    # keep for the next grid, addDriver shows it again
+                    widgetToRemove.widget().setParent(None)
+                else:
+                    widgetToRemove.widget().deleteLater()
             racemode = self.vLayout.takeAt(3)
             mainItem = self.vLayout.takeAt(2)
             self.vLayout.removeItem(racemode)
@@ -721,13 +1018,7 @@ class RmsFrame(QFrame):
             self.vLayout.addWidget(self.racemode)
 
     def clearCU(self):
-        # discard remaining timer messages
-        status = self.cu.poll()
-        while not isinstance(status, ControlUnit.Status):
-            status = self.cu.poll()
-        self.status = status
-        # reset cu timer
-        self.cu.reset()
+        self.cu.clear()
 
     def pressCode(self):
         print("press Code")
@@ -762,166 +1053,146 @@ class RmsFrame(QFrame):
                 self.driverChangeText[0] + "\n" + "Ctrl: " + str(driverObj.CtrlNum)
             )
             driverObj.name = self.driverChangeText[0]
+            self.viewModel.clear()
 
     def updateDisplay(self, binMode):
         if binMode != None:
-            if binMode[2] == "1":
-                self.fuelmode.setText("Real")
-            elif binMode[3] == "1":
-                self.fuelmode.setText("On")
-            elif binMode[3] == "0":
-                self.fuelmode.setText("Off")
-            if binMode[1] == "1":
-                self.pitLaneStatus.setText("Exists")
-            else:
-                self.pitLaneStatus.setText("Missing")
-            if binMode[0] == "1":
-                self.lapCounter.setText("Exists")
-            else:
-                self.lapCounter.setText("Missing")
+            if self.cellChanged(0, "mode", binMode):
+                if binMode[2] == "1":
+                    self.fuelmode.setText("Real")
+                elif binMode[3] == "1":
+                    self.fuelmode.setText("On")
+                elif binMode[3] == "0":
+                    self.fuelmode.setText("Off")
+                if binMode[1] == "1":
+                    self.pitLaneStatus.setText("Exists")
+                else:
+                    self.pitLaneStatus.setText("Missing")
+                if binMode[0] == "1":
+                    self.lapCounter.setText("Exists")
+                else:
+                    self.lapCounter.setText("Missing")
 
-        driversInPlay = [driver for driver in self.driverArr if driver.time]
-        if len(driversInPlay) + 1 > self.mainLayout.rowCount():
+        driversInPlay = self.engine.standings.order
+        while len(driversInPlay) + 1 > self.mainLayout.rowCount():
             self.addDriver()
-        for pos, driver in enumerate(sorted(driversInPlay, key=posgetter), start=1):
+        for pos, driver in enumerate(driversInPlay, start=1):
             if pos == 1:
                 if hasattr(self, "leader") and self.leader != driver:
                     print("pos change")
                 #                self.animation.start()
                 self.leader = driver
-                t = formattime(driver.time - self.start, True)
+                t = formattime(driver.time - self.engine.start, True)
             elif driver.lapcount == self.leader.lapcount:
                 t = "+%ss" % formattime(driver.time - self.leader.time)
             else:
                 gap = self.leader.lapcount - driver.lapcount
                 t = "+%d Lap%s" % (gap, "s" if gap != 1 else "")
-            self.driverBtn[pos].setText(
-                driver.name + "\n" + "Ctrl: " + str(driver.CtrlNum)
-            )
-            self.totalTime[pos].setText(t)
-            self.lapcount[pos].display(driver.lapcount)
-            self.laptime[pos].display(formattime(driver.lapTime))
-            self.bestlaptime[pos].display(formattime(driver.bestLapTime))
-            self.fuelbar[pos].setValue(driver.fuellevel)
-            if driver.fuellevel > 0:
-                self.fuelbar[pos].setStyleSheet(
-                    "QProgressBar{ color: white; background-color: black; border: 5px solid black; border-radius: 10px; text-align: center}\
-                                                 QProgressBar::chunk { background: qlineargradient(x1: 1, y1: 0.5, x2: 0, y2: 0.5, stop: 0 #00AA00, stop: "
-                    + str(0.92 - (1 / (driver.fuellevel)))
-                    + " #22FF22, stop: "
-                    + str(0.921 - (1 / (driver.fuellevel)))
-                    + " #22FF22, stop: "
-                    + str(1.001 - (1 / (driver.fuellevel)))
-                    + " red, stop: 1 #550000); }"
-                )
-            self.pits[pos].display(driver.pitcount)
+            name = driver.name + "\n" + "Ctrl: " + str(driver.CtrlNum)
+            if self.cellChanged(pos, "name", name):
+                self.driverBtn[pos].setText(name)
+            if self.cellChanged(pos, "total", t):
+                self.totalTime[pos].setText(t)
+            if self.cellChanged(pos, "laps", driver.lapcount):
+                self.lapcount[pos].display(driver.lapcount)
+            if self.cellChanged(pos, "laptime", driver.lapTime):
+                self.laptime[pos].display(formattime(driver.lapTime))
+            if self.cellChanged(pos, "best", driver.bestLapTime):
+                self.bestlaptime[pos].display(formattime(driver.bestLapTime))
+            if self.cellChanged(pos, "fuel", driver.fuellevel):
+                self.fuelbar[pos].setValue(driver.fuellevel)
+            if self.cellChanged(pos, "pits", driver.pitcount):
+                self.pits[pos].display(driver.pitcount)
+            for key, header in self.statsColumns:
+                text = lapstats.formatstat(driver, key)
+                if self.cellChanged(pos, key, text):
+                    self.stats[pos][key].setText(text)
         if hasattr(self, "leader") and self.session.session != None:
             if self.session.type != None:
-                self.racemode.setText(
+                racemode = (
                     self.session.session
                     + " "
                     + str(self.session.amount)
                     + " "
                     + self.session.type
                 )
-            if self.session.type == "Laps":
-                if self.leader.lapcount > self.session.amount:
-                    self.racestart()
-                    self.session.saveSessionData(driversInPlay)
-                    self.clearCU()
-                    self.session.sessionOver()
-            elif self.session.type == "Timed":
-                if self.leader.time - self.start > self.session.amount * 60000:
-                    self.racestart()
-                    self.session.saveSessionData(driversInPlay)
-                    self.clearCU()
-                    self.session.sessionOver()
-            elif self.session.type == None:
-                self.session.session = None
-                self.showLeaderboard()
-
-    def showLeaderboard(self):
-        self.leaderBoard = LBDialog(self.session.leaderboard)
+                if self.cellChanged(0, "racemode", racemode):
+                    self.racemode.setText(racemode)
+
+    def sessionOver(self, session, results):
+        self.racestart()
+        if session == "Qualification":
+            self.showStartRanking = StartRankDialog(results)
+            self.showStartRanking.show()
+        self.clearCU()
+
+    def refreshDisplay(self):
+        if self.displayDirty:
+            self.displayDirty = False
+            if metrics.registry is not None:
+                frameStart = time.perf_counter()
+            self.updateDisplay(self.binMode)
+            if metrics.registry is not None:
+                metrics.registry.observe(
+                    "rms_frame_seconds", time.perf_counter() - frameStart
+                )
+            if latency.tracer is not None:
+                latency.tracer.paint()
+
+    def cellChanged(self, pos, column, value):
+        key = (pos, column)
+        if key in self.viewModel and self.viewModel[key] == value:
+            return False
+        self.viewModel[key] = value
+        return True
+
+    def showLeaderboard(self, leaderboard):
+        self.leaderBoard = LBDialog(leaderboard)
         self.leaderBoard.show()
 
 
-class RaceSession(QObject):
-    def __init__(self):
-        super().__init__()
-        self.amount = None
-        self.session = None
-        self.sessionSteps = ["Practice", "Qualification", "Race"]
-
-    def setRace(self, raceDict):
-        self.leaderboard = {}
-        self.raceDict = raceDict
-        for stepIdx, step in enumerate(self.sessionSteps):
-            if step in raceDict:
-                self.type = raceDict[step]["mode"]
-                self.amount = int(raceDict[step]["amount"])
-                self.session = step
-                self.currentStep = stepIdx
-                break
-
-    def sessionOver(self):
-        for step in self.sessionSteps:
-            self.currentStep += 1
-            if len(self.sessionSteps) > self.currentStep:
-                if self.sessionSteps[self.currentStep] in self.raceDict:
-                    self.session = self.sessionSteps[self.currentStep]
-                    self.amount = int(
-                        self.raceDict[self.sessionSteps[self.currentStep]]["amount"]
-                    )
-                    self.type = self.raceDict[self.sessionSteps[self.currentStep]][
-                        "mode"
-                    ]
-                    break
-            else:
-                self.type = None
-                self.session = "Race Finished"
-
-    def saveSessionData(self, driverArr):
-        if self.sessionSteps[self.currentStep] == "Qualification":
-            self.showStartRanking = StartRankDialog(driverArr)
-            self.showStartRanking.exec_()
-
-        self.leaderboard[self.sessionSteps[self.currentStep]] = []
-        for driver in sorted(driverArr, key=posgetter):
-            self.leaderboard[self.sessionSteps[self.currentStep]].append(
-                {
-                    "laps": driver.lapcount,
-                    "total": driver.time,
-                    "best": driver.bestLapTime,
-                    "pits": driver.pitcount,
-                    "name": driver.name,
-                }
-            )
-            driver.bestLapTime = None
-            driver.time = None
-            driver.lapcount = 0
-            driver.pitcount = 0
+class LatencyOverlay(QLabel):
+    """Debug overlay with the latency percentiles of the latency tracer."""
+
+    def __init__(self, parent, tracer):
+        super().__init__(parent)
+        self.tracer = tracer
+        self.setFont(QFont("Monospace", 10))
+        self.setStyleSheet(
+            "QLabel{ background-color: rgba(0, 0, 0, 160); color: white}"
+        )
+        self.move(10, 10)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh(self):
+        self.setText(self.tracer.report())
+        self.adjustSize()
+        self.raise_()
 
 
 class StartRankDialog(QDialog):
-    def __init__(self, driverArr):
+    def __init__(self, results):
         super().__init__()
-        self.driverArr = driverArr
+        self.results = results
         self.setWindowTitle("Starting Grid")
         self.setupUI()
 
     def setupUI(self):
         self.vlayout = QVBoxLayout(self)
         self.vlayout.addWidget(QLabel("Starting Grid"))
-        self.table = QTableWidget(len(self.driverArr), 3)
+        self.table = QTableWidget(len(self.results), 3)
         self.vlayout.addWidget(self.table)
         self.table.verticalHeader().hide()
         self.table.setHorizontalHeaderLabels(["Grid Position", "Driver", "Best Lap"])
-        for idx, driver in enumerate(
-            sorted(self.driverArr, key=lambda x: (x.bestLapTime is None, x.bestLapTime))
+        for idx, driverInfo in enumerate(
+            sorted(self.results, key=lambda x: (x["best"] is None, x["best"]))
         ):
             self.table.setItem(idx, 0, QTableWidgetItem(str(idx + 1)))
-            self.table.setItem(idx, 1, QTableWidgetItem(driver.name))
-            self.table.setItem(idx, 2, QTableWidgetItem(formattime(driver.bestLapTime)))
+            self.table.setItem(idx, 1, QTableWidgetItem(driverInfo["name"]))
+            self.table.setItem(idx, 2, QTableWidgetItem(formattime(driverInfo["best"])))
         self.okBtn = QPushButton("Ok")
         self.vlayout.addWidget(self.okBtn)
         self.okBtn.clicked.connect(self.accept)
@@ -964,24 +1235,20 @@ class LBDialog(QTabWidget):
 
 
 class RmsDriver(QObject):
-    def __init__(self, driverNum):
+    """Widgets of one row of the driver grid, set up from a RaceDriver."""
+
+    def __init__(self, driver):
         super().__init__()
-        self.CtrlNum = driverNum
-        self.name = "Driver " + str(driverNum)
-        self.lapcount = 0
-        self.bestLapTime = None
-        self.lapTime = None
-        self.time = None
-        self.fuellevel = 15
-        self.pitcount = 0
-        self.pit = False
+        self.driver = driver
         self.buildDriver()
 
     def buildDriver(self):
         self.nameFont = QFont()
         self.nameFont.setPointSize(20)
         self.nameFont.setBold(True)
-        self.nameBtn = QPushButton(self.name + "\n" + "Ctrl: " + str(self.CtrlNum))
+        self.nameBtn = QPushButton(
+            self.driver.name + "\n" + "Ctrl: " + str(self.driver.CtrlNum)
+        )
         self.nameBtn.setToolTip("Click to change driver name")
         self.nameBtn.setFont(self.nameFont)
         self.nameBtn.setStyleSheet(
@@ -995,7 +1262,7 @@ class RmsDriver(QObject):
         lcdPalette = self.lapCountLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.lapCountLCD.setPalette(lcdPalette)
-        self.lapCountLCD.display(self.lapcount)
+        self.lapCountLCD.display(self.driver.lapcount)
 
         self.bestLapLCD = QLCDNumber()
         self.bestLapLCD.setStyleSheet(
@@ -1004,7 +1271,7 @@ class RmsDriver(QObject):
         lcdPalette = self.bestLapLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.bestLapLCD.setPalette(lcdPalette)
-        self.bestLapLCD.display(self.bestLapTime)
+        self.bestLapLCD.display(self.driver.bestLapTime)
 
         self.lapLCD = QLCDNumber()
         self.lapLCD.setStyleSheet(
@@ -1013,23 +1280,10 @@ class RmsDriver(QObject):
         lcdPalette = self.lapLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.lapLCD.setPalette(lcdPalette)
-        self.lapLCD.display(self.lapTime)
-
-        self.fuelbar = QProgressBar()
-        self.fuelbar.setOrientation(Qt.Horizontal)
-        self.fuelbar.setStyleSheet(
-            "QProgressBar{ color: white; background-color: black; border: 5px solid black; border-radius: 10px; text-align: center}\
-                                    QProgressBar::chunk { background: qlineargradient(x1: 1, y1: 0.5, x2: 0, y2: 0.5, stop: 0 #00AA00, stop: "
-            + str(0.92 - (1 / (self.fuellevel)))
-            + " #22FF22, stop: "
-            + str(0.921 - (1 / (self.fuellevel)))
-            + " #22FF22, stop: "
-            + str(1.001 - (1 / (self.fuellevel)))
-            + " red, stop: 1 #550000); }"
-        )
-        self.fuelbar.setMinimum(0)
-        self.fuelbar.setMaximum(15)
-        self.fuelbar.setValue(self.fuellevel)
+        self.lapLCD.display(self.driver.lapTime)
+
+        self.fuelbar = FuelGauge()
+        self.fuelbar.setValue(self.driver.fuellevel)
 
         self.pitCountLCD = QLCDNumber(2)
         self.pitCountLCD.setStyleSheet(
@@ -1038,10 +1292,31 @@ class RmsDriver(QObject):
         lcdPalette = self.pitCountLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 0, 0))
         self.pitCountLCD.setPalette(lcdPalette)
-        self.pitCountLCD.display(self.pitcount)
+        self.pitCountLCD.display(self.driver.pitcount)
+
+    def refresh(self):
+        """Show the state of the driver again, e.g. after it was reset."""
+        self.nameBtn.setText(
+            self.driver.name + "\n" + "Ctrl: " + str(self.driver.CtrlNum)
+        )
+        self.lapCountLCD.display(self.driver.lapcount)
+        self.bestLapLCD.display(self.driver.bestLapTime)
+        self.lapLCD.display(self.driver.lapTime)
+        self.fuelbar.setValue(self.driver.fuellevel)
+        self.pitCountLCD.display(self.driver.pitcount)
+
+    def getWidgets(self):
+        return (
+            self.nameBtn,
+            self.lapCountLCD,
+            self.bestLapLCD,
+            self.lapLCD,
+            self.fuelbar,
+            self.pitCountLCD,
+        )
 
     def getName(self):
-        return self.name
+        return self.driver.name
 
     def getNameBtn(self):
         return self.nameBtn
@@ -1058,21 +1333,9 @@ class RmsDriver(QObject):
     def getFuelBar(self):
         return self.fuelbar
 
-    def setCtrlNum(self, num):
-        self.CtrlNum = num
-        self.nameBtn.setText(self.name + "\n" + "Ctrl: " + str(self.CtrlNum))
-
     def getPits(self):
         return self.pitCountLCD
 
-    def newlap(self, timer):
-        if self.time is not None:
-            self.lapTime = timer.timestamp - self.time
-            if self.bestLapTime is None or self.lapTime < self.bestLapTime:
-                self.bestLapTime = self.lapTime
-            self.lapcount += 1
-        self.time = timer.timestamp
-
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -8,7 +8,6 @@ from PyQt5.QtWidgets import (
     QApplication,
     QWidget,
     QLCDNumber,
-    QProgressBar,
     QPushButton,
     QLabel,
     QFrame,
@@ -30,7 +29,7 @@ from PyQt5.QtWidgets import (
     QMainWindow,
 )
 
-from PyQt5.QtNetwork import QNetworkDatagram, QHostAddress, QUdpSocket
+from PyQt5.QtNetwork import QHostAddress, QUdpSocket
 
 from PyQt5.QtCore import (
     QTimer,
@@ -39,6 +38,8 @@ from PyQt5.QtCore import (
     QByteArray,
     pyqtProperty,
     QPropertyAnimation,
+    QRect,
+    QSize,
     Qt,
 )
 
@@ -52,15 +53,26 @@ except ImportError:
     QBluetoothDeviceDiscoveryAgent = None
 
 
-from PyQt5.QtGui import QKeySequence, QFont, QPainter, QPalette, QColor
+from PyQt5.QtGui import (
+    QKeySequence,
+    QFont,
+    QPainter,
+    QPalette,
+    QColor,
+    QLinearGradient,
+)
 
 import logging
 import protocol
 
+from pollscheduler import PollScheduler
+from raceengine import RaceEngine
+from racelog import RaceLog, logStarted, readLog, LOG_FILE
+import datagram, lapstats, latency, metrics
 
 # from carreralib import ControlUnit
-from collections import namedtuple
-import sys, os
+from collections import namedtuple, OrderedDict
+import sys, os, heapq, itertools, time
 
 DoNotUseBt = False
 if sys.platform == "darwin":
@@ -70,9 +82,12 @@ if sys.platform == "darwin":
 
 logger = logging.getLogger(__name__)
 
+# number of CU polls per second while nothing special is happening
+POLL_RATE = 100
 
-def posgetter(driver):
-    return (-driver.lapcount, driver.time)
+# number of display updates per second, independent of the CU event rate,
+# can be overridden with the environment variable RMS_REFRESH_RATE
+REFRESH_RATE = 30
 
 
 def formattime(time, longfmt=False):
@@ -137,6 +152,67 @@ class StartLight(QWidget):
         painter.drawEllipse(0, 0, self.width(), self.height())
 
 
+def fuelGradientStops(level):
+    # same colors as the former QProgressBar style sheet, the red part grows
+    # as the fuel level drops
+    stops = [
+        (0.0, QColor("#00AA00")),
+        (0.92 - 1 / level, QColor("#22FF22")),
+        (0.921 - 1 / level, QColor("#22FF22")),
+        (1.001 - 1 / level, QColor("red")),
+        (1.0, QColor("#550000")),
+    ]
+    return [(min(max(stop, 0.0), 1.0), color) for stop, color in stops]
+
+
+class FuelGauge(QWidget):
+    """Fuel level bar which paints its gradient itself.
+
+    The CU only reports 16 fuel levels, so the gradient stops for every
+    level are computed once and a repaint is only scheduled when the
+    level changes.
+    """
+
+    MAXIMUM = 15
+    STOPS = [None] + [fuelGradientStops(level) for level in range(1, MAXIMUM + 1)]
+
+    def __init__(self):
+        super().__init__()
+        self.level = 0
+
+    def sizeHint(self):
+        return QSize(117, 39)
+
+    def minimumSizeHint(self):
+        return QSize(117, 23)
+
+    def value(self):
+        return self.level
+
+    def setValue(self, level):
+        if level != self.level:
+            self.level = level
+            self.update()
+
+    def paintEvent(self, e):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(Qt.black)
+        painter.drawRoundedRect(self.rect(), 10, 10)
+        inner = self.rect().adjusted(5, 5, -5, -5)
+        if self.level > 0:
+            chunk = QRect(inner)
+            chunk.setWidth(inner.width() * self.level // self.MAXIMUM)
+            gradient = QLinearGradient(chunk.topRight(), chunk.topLeft())
+            gradient.setStops(self.STOPS[self.level])
+            painter.fillRect(chunk, gradient)
+        painter.setPen(Qt.white)
+        painter.drawText(
+            inner, Qt.AlignCenter, "%d%%" % (self.level * 100 // self.MAXIMUM)
+        )
+
+
 class StartLights(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -162,8 +238,16 @@ class Rms(QMainWindow):
     def __init__(self):
         super().__init__()
 
+        try:
+            self.refreshRate = int(os.environ.get("RMS_REFRESH_RATE", REFRESH_RATE))
+        except ValueError:
+            self.refreshRate = 0
+        if self.refreshRate <= 0:
+            sys.exit("the refresh rate RMS_REFRESH_RATE must be at least 1 per second")
         self.CUconnected = False
         self.shutdown = False
+        self.scheduler = PollScheduler(POLL_RATE)
+        self.pollRate = 0.0
         if DoNotUseBt:
             self.connectBTudp()
         else:
@@ -198,6 +282,9 @@ class Rms(QMainWindow):
     def closeEvent(self, event):
         self.shutdown = True
         self.cu.close()
+        self.rmsframe.engine.log.close()
+        if latency.tracer is not None:
+            latency.tracer.export()
         event.accept()
 
     def discoverCU(self):
@@ -256,11 +343,15 @@ class Rms(QMainWindow):
 
     def readUDP(self):
         while self.udpSocket.hasPendingDatagrams():
-            newDatagram = self.udpSocket.receiveDatagram()
-            if newDatagram.data() == "nocu":
-                print("No CU connected")
-                sys.exit()
-            self.cu.receivedUDP(bytes(newDatagram.data()))
+            # readDatagram returns the data as bytes right away, unlike
+            # receiveDatagram which needs another copy out of a QByteArray
+            udpData, host, port = self.udpSocket.readDatagram(
+                self.udpSocket.pendingDatagramSize()
+            )
+            arrival = None
+            if latency.tracer is not None:
+                arrival = latency.tracer.arrived()
+            self.cu.receivedUDP(udpData, arrival)
 
     def startRMS(self, device):
         print("start rms")
@@ -280,7 +371,7 @@ class Rms(QMainWindow):
         self.startLights.resize(
             int(rectDesktop.width() / 2), int((rectDesktop.width() / 2) / 5)
         )
-        self.rmsframe = RmsFrame(self.cu)
+        self.rmsframe = RmsFrame(self.cu, self.refreshRate)
         self.startLights.spacekey.activated.connect(self.rmsframe.racestart)
         self.setCentralWidget(self.rmsframe)
         self.showMaximized()
@@ -289,9 +380,32 @@ class Rms(QMainWindow):
         self.last = None
         self.cu.poll()
 
+    def schedulePoll(self, data):
+        delay = self.scheduler.next(
+            isinstance(data, ControlUnit.Timer), data == self.last
+        )
+        if self.scheduler.pollRate != self.pollRate:
+            self.pollRate = self.scheduler.pollRate
+            self.statusBar().showMessage("Poll rate: %.0f Hz" % self.pollRate)
+            if metrics.registry is not None:
+                metrics.registry.set("rms_poll_rate_hz", self.pollRate)
+        if delay > 0:
+            QTimer.singleShot(int(delay * 1000), self.cu.poll)
+        else:
+            # timer events are pending, keep several polls on their way
+            self.cu.poll(self.cu.MAX_INFLIGHT)
+
     def handle_data(self, data):
+        if metrics.registry is not None:
+            metrics.registry.inc("rms_polls_total")
+            if data == self.last:
+                metrics.registry.inc("rms_duplicate_frames_total")
+            elif isinstance(data, ControlUnit.Timer):
+                metrics.registry.inc('rms_events_total{kind="timer"}')
+            else:
+                metrics.registry.inc('rms_events_total{kind="status"}')
         if data == self.last:
-            self.cu.poll()
+            self.schedulePoll(data)
             return
         elif isinstance(data, ControlUnit.Status):
             self.handle_status(data)
@@ -299,8 +413,8 @@ class Rms(QMainWindow):
             self.handle_timer(data)
         else:
             pass
+        self.schedulePoll(data)
         self.last = data
-        self.cu.poll()
         if self.shutdown:
             sys.exit()
 
@@ -327,23 +441,20 @@ class Rms(QMainWindow):
                 self.startLights.lightFive.setOn(False)
         else:
             self.startLights.hide()
-        for driver, fuel in zip(self.rmsframe.driverArr, status.fuel):
-            driver.fuellevel = fuel
-        for driver, pit in zip(self.rmsframe.driverArr, status.pit):
-            if pit and not driver.pit:
-                driver.pitcount += 1
-            driver.pit = pit
+        self.rmsframe.engine.handle_status(status)
         self.binmode = "{0:04b}".format(status.mode)
-        self.rmsframe.updateDisplay(self.binmode)
+        self.rmsframe.binMode = self.binmode
+        self.rmsframe.displayDirty = True
         self.status = status
 
     def handle_timer(self, timer):
         #        print(timer)
-        driver = self.rmsframe.driverArr[timer.address]
-        driver.newlap(timer)
-        if self.rmsframe.start is None:
-            self.rmsframe.start = timer.timestamp
-        self.rmsframe.updateDisplay()
+        if latency.tracer is not None:
+            latency.tracer.stage(timer, "handle")
+        self.rmsframe.engine.handle_timer(timer)
+        if latency.tracer is not None:
+            latency.tracer.stage(timer, "model")
+        self.rmsframe.displayDirty = True
 
 
 class CtrlDialog(QDialog):
@@ -555,12 +666,53 @@ class RaceModeDialog(QDialog):
 
 
 class RmsFrame(QFrame):
-    def __init__(self, cu):
+    def __init__(self, cu, refreshRate=REFRESH_RATE):
         super().__init__()
         self.cu = cu
-        self.session = RaceSession()
-        self.resetRMS()
+        self.engine = RaceEngine()
+        # optional columns with the rolling lap statistics
+        self.statsColumns = lapstats.enabledColumns()
+        # continue the race of the last run if it did not end with a reset,
+        # e.g. because of a crash
+        resumed = self.engine.replay(
+            readLog(LOG_FILE, ControlUnit.Status, ControlUnit.Timer),
+            logStarted(LOG_FILE),
+        )
+        self.engine.subscribe("sessionOver", self.sessionOver)
+        self.engine.subscribe("raceOver", self.showLeaderboard)
+        self.session = self.engine.session
+        # the widgets of the driver grid rows are created once and stay bound
+        # to the same RaceDriver, a reset only clears what they show
+        self.driverArr = [RmsDriver(driver) for driver in self.engine.drivers]
+        for row, driver in enumerate(self.driverArr, start=1):
+            driver.getNameBtn().clicked.connect(
+                lambda _, row=row: self.changeDriver(
+                    self.driverBtn[row], self.driverObj[row]
+                )
+            )
+        self.engine.log = RaceLog(LOG_FILE)
+        if resumed:
+            # the CU clock must keep running for the replayed lap times
+            self.viewModel = {}
+        else:
+            # starts the log afresh as well
+            self.resetRMS()
+        if metrics.registry is not None:
+            metrics.registry.gauge(
+                "rms_racelog_dropped",
+                "Events the race log could not keep up with",
+                lambda: self.engine.log.dropped,
+            )
         self.buildframe()
+        # CU events only update the drivers, the display follows at a fixed
+        # rate with whatever the latest state is
+        self.binMode = None
+        self.displayDirty = bool(resumed)
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.timeout.connect(self.refreshDisplay)
+        self.refreshTimer.start(1000 // refreshRate)
+        if latency.tracer is not None:
+            self.latencyOverlay = LatencyOverlay(self, latency.tracer)
         self.driverBtn = {}
         self.driverObj = {}
         self.lapcount = {}
@@ -569,6 +721,7 @@ class RmsFrame(QFrame):
         self.bestlaptime = {}
         self.fuelbar = {}
         self.pits = {}
+        self.stats = {}
 
     #        QBAcolor = QByteArray()
     #        QBAcolor.append('color')
@@ -688,7 +841,7 @@ class RmsFrame(QFrame):
             "Best Lap",
             "Fuel",
             "Pits",
-        ]
+        ] + [header for key, header in self.statsColumns]
         for index, label in enumerate(self.labelArr):
             self.headerLabel = QLabel(label)
             self.headerLabel.setFont(self.headerFont)
@@ -700,24 +853,24 @@ class RmsFrame(QFrame):
         self.mainLayout.setColumnStretch(5, 3)
         self.mainLayout.setColumnStretch(6, 2)
         self.mainLayout.setColumnStretch(7, 1)
+        for column in range(len(self.statsColumns)):
+            self.mainLayout.setColumnStretch(8 + column, 2)
         return self.mainLayout
 
     def openCtrlDialog(self):
-        self.ctrlDialog = CtrlDialog(self.driverArr)
+        self.ctrlDialog = CtrlDialog(self.engine.drivers)
         if self.ctrlDialog.exec_():
-            self.driverArr = self.ctrlDialog.newDriverArr
+            self.engine.setDrivers(self.ctrlDialog.newDriverArr)
+            self.viewModel.clear()
+            self.displayDirty = True
 
     def openRaceDlg(self):
         self.setupRaceDlg = RaceModeDialog()
         self.session.session = None
         self.session.type = None
         if self.setupRaceDlg.exec_():
-            for driver in self.driverArr:
-                driver.bestLapTime = None
-                driver.time = None
-                driver.lapcount = 0
-                driver.pitcount = 0
-            self.session.setRace(self.setupRaceDlg.getRaceModeInfo())
+            self.viewModel.clear()
+            self.engine.setRace(self.setupRaceDlg.getRaceModeInfo())
             self.racemode.setText(
                 self.session.session
                 + " "
@@ -766,12 +919,7 @@ class RmsFrame(QFrame):
             QSizePolicy.Preferred, QSizePolicy.Expanding
         )
         self.mainLayout.addWidget(self.driverBtn[driverRow], driverRow, 1)
-        self.driverObj[driverRow] = driver
-        self.driverBtn[driverRow].clicked.connect(
-            lambda: self.changeDriver(
-                self.driverBtn[driverRow], self.driverObj[driverRow]
-            )
-        )
+        self.driverObj[driverRow] = driver.driver
         self.lapcount[driverRow] = driver.getLapCountLCD()
         self.lapcount[driverRow].setSizePolicy(
             QSizePolicy.Preferred, QSizePolicy.Expanding
@@ -807,30 +955,47 @@ class RmsFrame(QFrame):
         self.pits[driverRow] = driver.getPits()
         self.pits[driverRow].setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
         self.mainLayout.addWidget(self.pits[driverRow], driverRow, 7)
+        self.stats[driverRow] = {}
+        for column, (key, header) in enumerate(self.statsColumns, start=8):
+            label = QLabel("-")
+            label.setStyleSheet(
+                "QLabel{ border-radius: 10px; border-color: black; border: 5px solid black; background-color: white}"
+            )
+            label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
+            label.setFont(self.totalFont)
+            label.setAlignment(Qt.AlignCenter)
+            self.stats[driverRow][key] = label
+            self.mainLayout.addWidget(label, driverRow, column)
 
     def racestart(self):
-        self.start = None
         self.cu.start()
 
     #        self.mainLayout.itemAtPosition(1, 5).widget().setPits('Pit')
     #        self.mainLayout.itemAtPosition(1, 5).widget().setPits('Track')
 
     def resetRMS(self):
-        if hasattr(self, "driverArr"):
-            for driverObj in self.driverArr:
-                driverObj.deleteLater()
-        self.start = None
-        self.driverArr = [RmsDriver(num) for num in range(1, 9)]
+        self.engine.reset()
+        for driverObj in self.driverArr:
+            driverObj.refresh()
+        # last value shown in every cell of the driver grid by (row, column)
+        self.viewModel = {}
 
         self.clearreason = "reset"
         self.clearCU()
 
         if hasattr(self, "mainLayout"):
+            driverWidgets = set()
+            for driverObj in self.driverArr:
+                driverWidgets.update(driverObj.getWidgets())
             while True:
                 widgetToRemove = self.mainLayout.takeAt(0)
                 if widgetToRemove == None:
                     break
-                widgetToRemove.widget().deleteLater()
+                if widgetToRemove.widget() in driverWidgets:
+                    # keep for the next grid, addDriver shows it again
+                    widgetToRemove.widget().setParent(None)
+                else:
+                    widgetToRemove.widget().deleteLater()
             racemode = self.vLayout.takeAt(3)
             mainItem = self.vLayout.takeAt(2)
             self.vLayout.removeItem(racemode)
@@ -886,172 +1051,152 @@ class RmsFrame(QFrame):
                 self.driverChangeText[0] + "\n" + "Ctrl: " + str(driverObj.CtrlNum)
             )
             driverObj.name = self.driverChangeText[0]
+            self.viewModel.clear()
 
     def updateDisplay(self, binMode=None):
         if binMode != None:
-            if binMode[2] == "1":
-                self.fuelmode.setText("Real")
-            elif binMode[3] == "1":
-                self.fuelmode.setText("On")
-            elif binMode[3] == "0":
-                self.fuelmode.setText("Off")
-            if binMode[1] == "1":
-                self.pitLaneStatus.setText("Exists")
-            else:
-                self.pitLaneStatus.setText("Missing")
-            if binMode[0] == "1":
-                self.lapCounter.setText("Exists")
-            else:
-                self.lapCounter.setText("Missing")
-        driversInPlay = [driver for driver in self.driverArr if driver.time]
-        if len(driversInPlay) + 1 > self.mainLayout.rowCount():
+            if self.cellChanged(0, "mode", binMode):
+                if binMode[2] == "1":
+                    self.fuelmode.setText("Real")
+                elif binMode[3] == "1":
+                    self.fuelmode.setText("On")
+                elif binMode[3] == "0":
+                    self.fuelmode.setText("Off")
+                if binMode[1] == "1":
+                    self.pitLaneStatus.setText("Exists")
+                else:
+                    self.pitLaneStatus.setText("Missing")
+                if binMode[0] == "1":
+                    self.lapCounter.setText("Exists")
+                else:
+                    self.lapCounter.setText("Missing")
+        driversInPlay = self.engine.standings.order
+        while len(driversInPlay) + 1 > self.mainLayout.rowCount():
             self.addDriver()
-        for pos, driver in enumerate(sorted(driversInPlay, key=posgetter), start=1):
+        for pos, driver in enumerate(driversInPlay, start=1):
             if pos == 1:
                 if hasattr(self, "leader") and self.leader != driver:
                     print("pos change")
                 #                self.animation.start()
                 self.leader = driver
-                if self.start is None:
+                if self.engine.start is None:
                     t = "0.0"
                 else:
-                    t = formattime(driver.time - self.start, True)
+                    t = formattime(driver.time - self.engine.start, True)
             elif driver.lapcount == self.leader.lapcount:
                 t = "+%ss" % formattime(driver.time - self.leader.time)
             else:
                 gap = self.leader.lapcount - driver.lapcount
                 t = "+%d Lap%s" % (gap, "s" if gap != 1 else "")
-            self.driverBtn[pos].setText(
-                driver.name + "\n" + "Ctrl: " + str(driver.CtrlNum)
-            )
-            self.totalTime[pos].setText(t)
-            self.lapcount[pos].display(driver.lapcount)
-            self.laptime[pos].display(formattime(driver.lapTime))
-            self.bestlaptime[pos].display(formattime(driver.bestLapTime))
-            self.fuelbar[pos].setValue(driver.fuellevel)
-            if driver.fuellevel > 0:
-                self.fuelbar[pos].setStyleSheet(
-                    "QProgressBar{ color: white; background-color: black; border: 5px solid black; border-radius: 10px; text-align: center}\
-                                                 QProgressBar::chunk { background: qlineargradient(x1: 1, y1: 0.5, x2: 0, y2: 0.5, stop: 0 #00AA00, stop: "
-                    + str(0.92 - (1 / (driver.fuellevel)))
-                    + " #22FF22, stop: "
-                    + str(0.921 - (1 / (driver.fuellevel)))
-                    + " #22FF22, stop: "
-                    + str(1.001 - (1 / (driver.fuellevel)))
-                    + " red, stop: 1 #550000); }"
-                )
-            self.pits[pos].display(driver.pitcount)
+            name = driver.name + "\n" + "Ctrl: " + str(driver.CtrlNum)
+            if self.cellChanged(pos, "name", name):
+                self.driverBtn[pos].setText(name)
+            if self.cellChanged(pos, "total", t):
+                self.totalTime[pos].setText(t)
+            if self.cellChanged(pos, "laps", driver.lapcount):
+                self.lapcount[pos].display(driver.lapcount)
+            if self.cellChanged(pos, "laptime", driver.lapTime):
+                self.laptime[pos].display(formattime(driver.lapTime))
+            if self.cellChanged(pos, "best", driver.bestLapTime):
+                self.bestlaptime[pos].display(formattime(driver.bestLapTime))
+            if self.cellChanged(pos, "fuel", driver.fuellevel):
+                self.fuelbar[pos].setValue(driver.fuellevel)
+            if self.cellChanged(pos, "pits", driver.pitcount):
+                self.pits[pos].display(driver.pitcount)
+            for key, header in self.statsColumns:
+                text = lapstats.formatstat(driver, key)
+                if self.cellChanged(pos, key, text):
+                    self.stats[pos][key].setText(text)
         if (
             hasattr(self, "leader")
             and self.session.session is not None
-            and self.start is not None
+            and self.engine.start is not None
         ):
             if self.session.type != None:
-                self.racemode.setText(
+                racemode = (
                     self.session.session
                     + " "
                     + str(self.session.amount)
                     + " "
                     + self.session.type
                 )
-            if self.session.type == "Laps":
-                if self.leader.lapcount > self.session.amount:
-                    self.stopSession(driversInPlay, self.start)
-            elif self.session.type == "Timed":
-                if self.leader.time - self.start > self.session.amount * 60000:
-                    self.stopSession(driversInPlay, self.start)
-            if self.session.type == None:
-                self.session.session = None
-                self.showLeaderboard()
-
-    def stopSession(self, driversInPlay, start):
+                if self.cellChanged(0, "racemode", racemode):
+                    self.racemode.setText(racemode)
+
+    def sessionOver(self, session, results):
         self.racestart()
-        self.session.saveSessionData(driversInPlay, start)
+        if session == "Qualification":
+            self.showStartRanking = StartRankDialog(results)
+            self.showStartRanking.show()
         self.clearCU()
-        self.session.sessionOver()
 
-    def showLeaderboard(self):
-        self.leaderBoard = LBDialog(self.session.leaderboard)
+    def refreshDisplay(self):
+        if self.displayDirty:
+            self.displayDirty = False
+            if metrics.registry is not None:
+                frameStart = time.perf_counter()
+            self.updateDisplay(self.binMode)
+            if metrics.registry is not None:
+                metrics.registry.observe(
+                    "rms_frame_seconds", time.perf_counter() - frameStart
+                )
+            if latency.tracer is not None:
+                latency.tracer.paint()
+
+    def cellChanged(self, pos, column, value):
+        key = (pos, column)
+        if key in self.viewModel and self.viewModel[key] == value:
+            return False
+        self.viewModel[key] = value
+        return True
+
+    def showLeaderboard(self, leaderboard):
+        self.leaderBoard = LBDialog(leaderboard)
         self.leaderBoard.show()
 
 
-class RaceSession(QObject):
-    def __init__(self):
-        super().__init__()
-        self.amount = None
-        self.session = None
-        self.sessionSteps = ["Practice", "Qualification", "Race"]
-
-    def setRace(self, raceDict):
-        self.leaderboard = {}
-        self.raceDict = raceDict
-        for stepIdx, step in enumerate(self.sessionSteps):
-            if step in raceDict:
-                self.type = raceDict[step]["mode"]
-                self.amount = int(raceDict[step]["amount"])
-                self.session = step
-                self.currentStep = stepIdx
-                break
+class LatencyOverlay(QLabel):
+    """Debug overlay with the latency percentiles of the latency tracer."""
 
-    def sessionOver(self):
-        for step in self.sessionSteps:
-            self.currentStep += 1
-            if len(self.sessionSteps) > self.currentStep:
-                if self.sessionSteps[self.currentStep] in self.raceDict:
-                    self.session = self.sessionSteps[self.currentStep]
-                    self.amount = int(
-                        self.raceDict[self.sessionSteps[self.currentStep]]["amount"]
-                    )
-                    self.type = self.raceDict[self.sessionSteps[self.currentStep]][
-                        "mode"
-                    ]
-                    break
-            else:
-                self.type = None
-                self.session = "Race Finished"
-
-    def saveSessionData(self, driverArr, start):
-        if self.sessionSteps[self.currentStep] == "Qualification":
-            self.showStartRanking = StartRankDialog(driverArr)
-            self.showStartRanking.exec_()
-
-        self.leaderboard[self.sessionSteps[self.currentStep]] = []
-        for driver in sorted(driverArr, key=posgetter):
-            self.leaderboard[self.sessionSteps[self.currentStep]].append(
-                {
-                    "laps": driver.lapcount,
-                    "total": driver.time - start,
-                    "best": driver.bestLapTime,
-                    "pits": driver.pitcount,
-                    "name": driver.name,
-                }
-            )
-            driver.bestLapTime = None
-            driver.time = None
-            driver.lapcount = 0
-            driver.pitcount = 0
+    def __init__(self, parent, tracer):
+        super().__init__(parent)
+        self.tracer = tracer
+        self.setFont(QFont("Monospace", 10))
+        self.setStyleSheet(
+            "QLabel{ background-color: rgba(0, 0, 0, 160); color: white}"
+        )
+        self.move(10, 10)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh(self):
+        self.setText(self.tracer.report())
+        self.adjustSize()
+        self.raise_()
 
 
 class StartRankDialog(QDialog):
-    def __init__(self, driverArr):
+    def __init__(self, results):
         super().__init__()
-        self.driverArr = driverArr
+        self.results = results
         self.setWindowTitle("Starting Grid")
         self.setupUI()
 
     def setupUI(self):
         self.vlayout = QVBoxLayout(self)
         self.vlayout.addWidget(QLabel("Starting Grid"))
-        self.table = QTableWidget(len(self.driverArr), 3)
+        self.table = QTableWidget(len(self.results), 3)
         self.vlayout.addWidget(self.table)
         self.table.verticalHeader().hide()
         self.table.setHorizontalHeaderLabels(["Grid Position", "Driver", "Best Lap"])
-        for idx, driver in enumerate(
-            sorted(self.driverArr, key=lambda x: (x.bestLapTime is None, x.bestLapTime))
+        for idx, driverInfo in enumerate(
+            sorted(self.results, key=lambda x: (x["best"] is None, x["best"]))
         ):
             self.table.setItem(idx, 0, QTableWidgetItem(str(idx + 1)))
-            self.table.setItem(idx, 1, QTableWidgetItem(driver.name))
-            self.table.setItem(idx, 2, QTableWidgetItem(formattime(driver.bestLapTime)))
+            self.table.setItem(idx, 1, QTableWidgetItem(driverInfo["name"]))
+            self.table.setItem(idx, 2, QTableWidgetItem(formattime(driverInfo["best"])))
         self.okBtn = QPushButton("Ok")
         self.vlayout.addWidget(self.okBtn)
         self.okBtn.clicked.connect(self.accept)
@@ -1094,24 +1239,20 @@ class LBDialog(QTabWidget):
 
 
 class RmsDriver(QObject):
-    def __init__(self, driverNum):
+    """Widgets of one row of the driver grid, set up from a RaceDriver."""
+
+    def __init__(self, driver):
         super().__init__()
-        self.CtrlNum = driverNum
-        self.name = "Driver " + str(driverNum)
-        self.lapcount = 0
-        self.bestLapTime = None
-        self.lapTime = None
-        self.time = None
-        self.fuellevel = 15
-        self.pitcount = 0
-        self.pit = False
+        self.driver = driver
         self.buildDriver()
 
     def buildDriver(self):
         self.nameFont = QFont()
         self.nameFont.setPointSize(20)
         self.nameFont.setBold(True)
-        self.nameBtn = QPushButton(self.name + "\n" + "Ctrl: " + str(self.CtrlNum))
+        self.nameBtn = QPushButton(
+            self.driver.name + "\n" + "Ctrl: " + str(self.driver.CtrlNum)
+        )
         self.nameBtn.setToolTip("Click to change driver name")
         self.nameBtn.setFont(self.nameFont)
         self.nameBtn.setStyleSheet(
@@ -1125,7 +1266,7 @@ class RmsDriver(QObject):
         lcdPalette = self.lapCountLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.lapCountLCD.setPalette(lcdPalette)
-        self.lapCountLCD.display(self.lapcount)
+        self.lapCountLCD.display(self.driver.lapcount)
 
         self.bestLapLCD = QLCDNumber(6)
         self.bestLapLCD.setStyleSheet(
@@ -1134,7 +1275,7 @@ class RmsDriver(QObject):
         lcdPalette = self.bestLapLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.bestLapLCD.setPalette(lcdPalette)
-        self.bestLapLCD.display(self.bestLapTime)
+        self.bestLapLCD.display(self.driver.bestLapTime)
 
         self.lapLCD = QLCDNumber(6)
         self.lapLCD.setStyleSheet(
@@ -1143,23 +1284,10 @@ class RmsDriver(QObject):
         lcdPalette = self.lapLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 255, 0))
         self.lapLCD.setPalette(lcdPalette)
-        self.lapLCD.display(self.lapTime)
-
-        self.fuelbar = QProgressBar()
-        self.fuelbar.setOrientation(Qt.Horizontal)
-        self.fuelbar.setStyleSheet(
-            "QProgressBar{ color: white; background-color: black; border: 5px solid black; border-radius: 10px; text-align: center}\
-                                    QProgressBar::chunk { background: qlineargradient(x1: 1, y1: 0.5, x2: 0, y2: 0.5, stop: 0 #00AA00, stop: "
-            + str(0.92 - (1 / (self.fuellevel)))
-            + " #22FF22, stop: "
-            + str(0.921 - (1 / (self.fuellevel)))
-            + " #22FF22, stop: "
-            + str(1.001 - (1 / (self.fuellevel)))
-            + " red, stop: 1 #550000); }"
-        )
-        self.fuelbar.setMinimum(0)
-        self.fuelbar.setMaximum(15)
-        self.fuelbar.setValue(self.fuellevel)
+        self.lapLCD.display(self.driver.lapTime)
+
+        self.fuelbar = FuelGauge()
+        self.fuelbar.setValue(self.driver.fuellevel)
 
         self.pitCountLCD = QLCDNumber(2)
         self.pitCountLCD.setStyleSheet(
@@ -1168,10 +1296,31 @@ class RmsDriver(QObject):
         lcdPalette = self.pitCountLCD.palette()
         lcdPalette.setColor(lcdPalette.WindowText, QColor(255, 0, 0))
         self.pitCountLCD.setPalette(lcdPalette)
-        self.pitCountLCD.display(self.pitcount)
+        self.pitCountLCD.display(self.driver.pitcount)
+
+    def refresh(self):
+        """Show the state of the driver again, e.g. after it was reset."""
+        self.nameBtn.setText(
+            self.driver.name + "\n" + "Ctrl: " + str(self.driver.CtrlNum)
+        )
+        self.lapCountLCD.display(self.driver.lapcount)
+        self.bestLapLCD.display(self.driver.bestLapTime)
+        self.lapLCD.display(self.driver.lapTime)
+        self.fuelbar.setValue(self.driver.fuellevel)
+        self.pitCountLCD.display(self.driver.pitcount)
+
+    def getWidgets(self):
+        return (
+            self.nameBtn,
+            self.lapCountLCD,
+            self.bestLapLCD,
+            self.lapLCD,
+            self.fuelbar,
+            self.pitCountLCD,
+        )
 
     def getName(self):
-        return self.name
+        return self.driver.name
 
     def getNameBtn(self):
         return self.nameBtn
@@ -1188,21 +1337,9 @@ class RmsDriver(QObject):
     def getFuelBar(self):
         return self.fuelbar
 
-    def setCtrlNum(self, num):
-        self.CtrlNum = num
-        self.nameBtn.setText(self.name + "\n" + "Ctrl: " + str(self.CtrlNum))
-
     def getPits(self):
         return self.pitCountLCD
 
-    def newlap(self, timer):
-        if self.time is not None:
-            self.lapTime = timer.timestamp - self.time
-            if self.bestLapTime is None or self.lapTime < self.bestLapTime:
-                self.bestLapTime = self.lapTime
-            self.lapcount += 1
-        self.time = timer.timestamp
-
 
 class ControlUnit(QObject):
     """Interface to a Carrera Digital 124/132 Control Unit."""
@@ -1276,15 +1413,61 @@ class ControlUnit(QObject):
     CODE_KEY = b"T8"
     """Request for emulating the Control Unit's CODE key."""
 
+    POLL_REQUEST = b"generalQuery"
+    """Request for polling the CU for timer events or its status."""
+
+    KEY_PRIORITY = 0
+    COMMAND_PRIORITY = 1
+    POLL_PRIORITY = 2
+
+    REQUEST_TIMEOUT = 250
+    """Milliseconds to wait for the answer to a request."""
+
+    REQUEST_RETRIES = 3
+    """Number of times a request is resent if no answer arrives."""
+
+    MAX_INFLIGHT = 4
+    """Number of requests which may be on their way to the CU at once."""
+
+    SEQ_MODULO = 10000
+    """Sequence numbers used to match answers to requests wrap at this value."""
+
     def __init__(self, device, **kwargs):
+        super().__init__()
         if isinstance(device, QUdpSocket):
             self.__connection = device
         else:
             logger.debug("Connecting to %s", device)
             self.__connection = connection.open(device, **kwargs)
             logger.debug("Connection established")
-        self.requestsent = None
-        self.stoprequest = False
+        # outbound requests as (priority, order, buf, timeout, retries)
+        self.queue = []
+        self.order = itertools.count()
+        # requests sent to the bridge by sequence number, in sending order
+        self.inflight = OrderedDict()
+        # answers which arrived before the answers to earlier requests
+        self.answers = {}
+        # when the answer being dispatched arrived, for the latency tracer
+        self.arrival = None
+        self.seq = 0
+        self.decodeStatus = datagram.StatusDecoder()
+        if metrics.registry is not None:
+            metrics.registry.counter(
+                "rms_udp_retransmits_total", "Requests sent again after a timeout"
+            )
+            metrics.registry.counter(
+                "rms_udp_lost_total", "Requests given up after all retries"
+            )
+            metrics.registry.gauge(
+                "rms_udp_inflight",
+                "Requests waiting for an answer of the bridge",
+                lambda: len(self.inflight),
+            )
+            metrics.registry.gauge(
+                "rms_udp_queue_depth",
+                "Requests waiting to be sent to the bridge",
+                lambda: len(self.queue),
+            )
 
     def close(self):
         """Close the connection to the CU."""
@@ -1299,69 +1482,186 @@ class ControlUnit(QObject):
         """Ignore the controllers represented by bitmask `mask`."""
         self.request(protocol.pack("cBC", b":", mask))
 
-    def request(self, buf=b"generalQuery", maxlength=None):
-        """Send a message to the CU and wait for a response.
-        The returned value will be an instance of either
+    def request(
+        self,
+        buf=POLL_REQUEST,
+        maxlength=None,
+        priority=None,
+        timeout=REQUEST_TIMEOUT,
+        retries=None,
+    ):
+        """Queue a message for the CU.
+        Up to MAX_INFLIGHT requests are on their way to the CU at any
+        time, the others wait in a queue ordered by priority: key presses
+        go first, then other commands and finally polls. Every datagram
+        carries a sequence number which the bridge copies into its answer,
+        so answers are matched to their requests and handed to
+        :meth:`dispatch` in the order the requests were sent, even if
+        the datagrams arrive out of order. A request which is not
+        answered within `timeout` milliseconds is sent again up to
+        `retries` times.
+        """
+        if priority is None:
+            if buf.startswith(b"T"):
+                priority = self.KEY_PRIORITY
+            elif buf == self.POLL_REQUEST:
+                priority = self.POLL_PRIORITY
+            else:
+                priority = self.COMMAND_PRIORITY
+        if retries is None:
+            # pressing a key twice is not the same as pressing it once
+            retries = 0 if priority == self.KEY_PRIORITY else self.REQUEST_RETRIES
+        heapq.heappush(self.queue, (priority, next(self.order), buf, timeout, retries))
+        self.sendNext()
+
+    def poll(self, depth=1):
+        """Ask the CU for pending timer events or its status.
+        The answer is passed to the main window as either
         :class:`ControlUnit.Timer` or :class:`ControlUnit.Status`,
-        depending on whether any timer events are pending.
+        depending on whether any timer events are pending. Up to `depth`
+        polls are kept on their way to the CU at the same time.
         """
-        if buf.startswith(b"T"):
-            self.stoprequest = True
-            while self.requestsent:
-                app.processEvents()
-            self.__connection.write(buf)
+        if any(item[2] == self.POLL_REQUEST for item in self.queue):
             return
-        logger.debug("Sending message %r", buf)
-        self.__connection.write(buf)
-        self.requestsent = True
-
-    def receivedUDP(self, udpData):
+        outstanding = sum(
+            1 for item in self.inflight.values() if item[2] == self.POLL_REQUEST
+        )
+        for _ in range(depth - outstanding):
+            self.request(self.POLL_REQUEST)
+
+    def sendNext(self):
+        while self.queue and len(self.inflight) < self.MAX_INFLIGHT:
+            self.send(heapq.heappop(self.queue))
+
+    def send(self, item):
+        buf, timeout = item[2], item[3]
+        self.seq = (self.seq + 1) % self.SEQ_MODULO
+        seq = self.seq
+        self.inflight[seq] = item
+        logger.debug("Sending message %d %r", seq, buf)
+        self.__connection.write(b"%d#%s" % (seq, buf))
+        QTimer.singleShot(timeout, lambda: self.requestTimeout(seq))
+
+    def requestTimeout(self, seq):
+        if seq not in self.inflight or seq in self.answers:
+            return
+        priority, order, buf, timeout, retries = self.inflight.pop(seq)
+        if retries > 0:
+            logger.warning("No answer to %r, sending again", buf)
+            if metrics.registry is not None:
+                metrics.registry.inc("rms_udp_retransmits_total")
+            self.send((priority, order, buf, timeout, retries - 1))
+        else:
+            logger.warning("No answer to %r, giving up", buf)
+            if metrics.registry is not None:
+                metrics.registry.inc("rms_udp_lost_total")
+        try:
+            self.deliver()
+        finally:
+            self.sendNext()
+        # make sure the poll loop keeps running
+        self.poll()
+
+    def receivedUDP(self, udpData, arrival=None):
         #       print(udpData)
-        self.requestsent = False
-        if self.stoprequest and not udpData.startswith(b"T"):
+        # the payload is not cut out of the datagram, it is passed on as
+        # the position where it starts
+        sep = udpData.find(b"#", 0, 6)
+        if sep < 1 or not udpData[:sep].isdigit():
+            logger.warning("Received message without sequence number %r", udpData)
             return
-        if udpData.startswith(b"T") or udpData.startswith(b"?T"):
-            self.poll()
-            self.stoprequest = False
-        elif udpData.startswith(b"?:"):
-            # recent CU versions report two extra unknown bytes with '?:'
-            try:
-                parts = protocol.unpack("2x8YYYBYC", udpData)
-            except protocol.ChecksumError:
-                parts = protocol.unpack("2x8YYYBYxxC", udpData)
-            fuel, (start, mode, pitmask, display) = parts[:8], parts[8:]
-            pit = tuple(pitmask & (1 << n) != 0 for n in range(8))
-            custat = ControlUnit.Status(fuel, start, mode, pit, display)
+        seq = int(udpData[:sep])
+        if seq not in self.inflight:
+            logger.debug("Ignoring late answer %d %r", seq, udpData)
+            return
+        self.answers[seq] = (udpData, sep + 1, arrival)
+        try:
+            self.deliver()
+        finally:
+            self.sendNext()
+
+    def deliver(self):
+        while self.inflight:
+            seq = next(iter(self.inflight))
+            if seq not in self.answers:
+                break
+            del self.inflight[seq]
+            udpData, pos, self.arrival = self.answers.pop(seq)
+            self.dispatch(udpData, pos)
+
+    def dispatch(self, udpData, pos=0):
+        """Handle the answer starting at `pos` within `udpData`."""
+        if pos < len(udpData):
+            handler = self.DISPATCH.get(udpData[pos], ControlUnit.dispatchOther)
+        else:
+            handler = ControlUnit.dispatchOther
+        handler(self, udpData, pos)
+
+    def dispatchQuery(self, udpData, pos):
+        kind = udpData[pos + 1 : pos + 2]
+        if kind == b":":
+            parts = self.decodeStatus(udpData, pos)
+            if parts is None:
+                logger.warning("Checksum error in status %r", udpData)
+                self.poll()
+                return
+            custat = ControlUnit.Status(*parts)
             w.handle_data(custat)
-        elif udpData.startswith(b"Reset&:") or udpData.startswith(b"?="):
-            if udpData.startswith(b"Reset"):
+        elif kind == b"=":
+            w.run()
+        elif kind == b"T":
+            self.poll()
+        else:
+            parts = datagram.decodeTimer(udpData, pos)
+            if parts is None:
+                logger.warning("Checksum error in timer %r", udpData)
                 self.poll()
-            else:
-                w.run()
-        elif udpData.startswith(b"?"):
-            address, timestamp, sector = protocol.unpack("xYIYC", udpData)
+                return
+            address, timestamp, sector = parts
             cutimer = ControlUnit.Timer(address - 1, timestamp, sector)
+            if latency.tracer is not None:
+                latency.tracer.receive(cutimer, self.arrival)
+                latency.tracer.stage(cutimer, "decode")
             w.handle_data(cutimer)
-        elif udpData.startswith(b"0"):
-            w.setVersion(protocol.unpack("x4sC", udpData)[0])
-            w.initUI()
-        elif udpData.startswith(b"clearCU"):
-            cudata = str(udpData, "utf-8").split("&")[1]
-            if cudata.startswith(":"):
-                cleardata = bytes("?" + cudata, "utf-8")
-                try:
-                    parts = protocol.unpack("2x8YYYBYC", cleardata)
-                except protocol.ChecksumError:
-                    parts = protocol.unpack("2x8YYYBYxxC", cleardata)
-                fuel, (start, mode, pitmask, display) = parts[:8], parts[8:]
-                pit = tuple(pitmask & (1 << n) != 0 for n in range(8))
-                cuclear = ControlUnit.Status(fuel, start, mode, pit, display)
-                w.rmsframe.clearCU(cuclear)
-            else:
+
+    def dispatchVersion(self, udpData, pos):
+        w.setVersion(protocol.unpack("x4sC", udpData[pos:])[0])
+        w.initUI()
+
+    def dispatchClearCU(self, udpData, pos):
+        if udpData.startswith(b"clearCU&:", pos):
+            # the "&" takes the place of the "?" of a status, which is not
+            # part of the checksum
+            parts = self.decodeStatus(udpData, pos + len(b"clearCU"))
+            if parts is None:
+                logger.warning("Checksum error in status %r", udpData)
                 self.request(b"clearCU")
+                return
+            cuclear = ControlUnit.Status(*parts)
+            w.rmsframe.clearCU(cuclear)
+        elif udpData.startswith(b"clearCU", pos):
+            self.request(b"clearCU")
         else:
             self.poll()
 
+    def dispatchNoCU(self, udpData, pos):
+        if udpData[pos:] == b"nocu":
+            print("No CU connected")
+            sys.exit()
+        self.poll()
+
+    def dispatchOther(self, udpData, pos):
+        # key presses, Reset&: and echoed commands
+        self.poll()
+
+    # handlers of the answers by their first character
+    DISPATCH = {
+        ord("?"): dispatchQuery,
+        ord("0"): dispatchVersion,
+        ord("c"): dispatchClearCU,
+        ord("n"): dispatchNoCU,
+    }
+
     def reset(self):
         """Reset the CU timer."""
         self.request(b"Reset")
@@ -0,0 +1,100 @@
+""" Sector times from the Check Lanes of the Carrera(R) Digital 124/132 """
+
+# sector reported by the start/finish line, Check Lanes report 2 and 3
+FINISH_LINE = 1
+
+
+class SectorTiming:
+    """Splits, best sectors and the live delta to the best lap of one car.
+
+    Sector n starts at the sensor which reports sector n, so sector 1
+    starts at the start/finish line, and ends at the next sensor of the
+    track. Which sensors the track has is learned from the timer events.
+    A split is only taken if the car passed the next sensor, not if it
+    was missed, e.g. while a Check Lane was being set up.
+
+    The delta is updated at every sensor and compares the time since the
+    car crossed the start/finish line with the time it took to get to
+    the same sensor in its best lap, negative means faster.
+
+    A lap has at most three sectors, so every update is O(1).
+    """
+
+    __slots__ = (
+        "sensors",
+        "lastSensor",
+        "lastTime",
+        "lapStart",
+        "splits",
+        "lapSplits",
+        "lastLapSplits",
+        "bestSplits",
+        "elapsed",
+        "bestElapsed",
+        "bestLapTime",
+        "delta",
+    )
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sensors = {FINISH_LINE}
+        self.lastSensor = None
+        self.lastTime = None
+        self.lapStart = None
+        # last and best split by sector
+        self.splits = {}
+        self.bestSplits = {}
+        # splits of the lap in progress and of the last completed lap, a
+        # sector is missing if the car missed the sensor at either end
+        self.lapSplits = {}
+        self.lastLapSplits = {}
+        # time since the start of the lap at each Check Lane, for the
+        # current and the best lap
+        self.elapsed = {}
+        self.bestElapsed = {}
+        self.bestLapTime = None
+        self.delta = None
+
+    def nextSensor(self, sensor):
+        following = [s for s in self.sensors if s > sensor]
+        return min(following) if following else FINISH_LINE
+
+    def passed(self, sensor, timestamp):
+        """Account for the car passing `sensor` at race time `timestamp`."""
+        self.sensors.add(sensor)
+        if self.lastTime is not None and self.nextSensor(self.lastSensor) == sensor:
+            split = timestamp - self.lastTime
+            self.splits[self.lastSensor] = split
+            self.lapSplits[self.lastSensor] = split
+            best = self.bestSplits.get(self.lastSensor)
+            if best is None or split < best:
+                self.bestSplits[self.lastSensor] = split
+        if sensor == FINISH_LINE:
+            if self.lapStart is not None:
+                lapTime = timestamp - self.lapStart
+                if self.bestLapTime is None:
+                    self.delta = None
+                else:
+                    self.delta = lapTime - self.bestLapTime
+                if self.bestLapTime is None or lapTime < self.bestLapTime:
+                    self.bestLapTime = lapTime
+                    self.bestElapsed = self.elapsed
+            self.lapStart = timestamp
+            self.elapsed = {}
+            self.lastLapSplits = self.lapSplits
+            self.lapSplits = {}
+        elif self.lapStart is not None:
+            elapsed = timestamp - self.lapStart
+            self.elapsed[sensor] = elapsed
+            best = self.bestElapsed.get(sensor)
+            self.delta = None if best is None else elapsed - best
+        self.lastSensor = sensor
+        self.lastTime = timestamp
+
+    def theoreticalBest(self):
+        """Sum of the best sectors, None until every sector was timed."""
+        if len(self.bestSplits) < len(self.sensors):
+            return None
+        return sum(self.bestSplits[sensor] for sensor in self.sensors)
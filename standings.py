@@ -0,0 +1,43 @@
+""" Incrementally maintained race order for the race management system """
+
+import bisect
+
+
+class Standings:
+    """Drivers in race order, updated one line crossing at a time.
+
+    Instead of sorting all drivers on every event, only the driver who
+    just crossed the line is moved to its new position. :attr:`order`
+    always holds the current order and can be read without any work.
+    Drivers are ordered by `key`, which must be a tuple, e.g. posgetter.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.order = []
+        self.keys = []
+        self.driverKeys = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, driver):
+        """Move `driver` to its position after a new lap."""
+        oldKey = self.driverKeys.pop(driver, None)
+        if oldKey is not None:
+            idx = bisect.bisect_left(self.keys, oldKey)
+            del self.keys[idx]
+            del self.order[idx]
+        # drivers with equal keys keep the order in which they arrived
+        self.counter += 1
+        newKey = self.key(driver) + (self.counter,)
+        idx = bisect.bisect_right(self.keys, newKey)
+        self.keys.insert(idx, newKey)
+        self.order.insert(idx, driver)
+        self.driverKeys[driver] = newKey
+
+    def clear(self):
+        self.order = []
+        self.keys = []
+        self.driverKeys = {}
@@ -0,0 +1,305 @@
+""" asyncio transports to the Control Unit over Bluetooth, the UDP bridge or locally
+
+All backends offer the same coroutines: poll() returns the next
+ControlUnit.Timer or ControlUnit.Status, request() sends a raw request
+and returns the answer, clear() discards pending timer events and
+resets the CU clock, and events() iterates over new events, polled at
+an adaptive rate. A device argument of rms.py, or udp:HOST[:PORT] for
+the UDP bridge, selects the backend, e.g.:
+prompt> python3 transport.py udp:192.168.1.20
+prompt> python3 transport.py sim:4@10
+
+rms.py runs the coroutines in an event loop of its poll thread, so CU
+I/O overlaps with painting.
+"""
+
+import abc, asyncio, sys
+from concurrent.futures import ThreadPoolExecutor
+
+from carreralib import ControlUnit, protocol
+
+import cusim, datagram, replaycu
+from pollscheduler import PollScheduler
+from raceengine import POLL_RATE, RaceEngine
+
+# prefix of the device argument that selects the UDP bridge
+DEVICE_PREFIX = "udp:"
+
+# port the btserver bridge listens on
+UDP_PORT = 8888
+
+
+def openDevice(device):
+    """Open the CU for a device argument of rms.py other than udp:."""
+    if device.startswith(replaycu.DEVICE_PREFIX):
+        return replaycu.ReplayControlUnit.fromDevice(device)
+    elif device.startswith(cusim.DEVICE_PREFIX):
+        return cusim.SimControlUnit.fromDevice(device)
+    return ControlUnit(device, timeout=1.0)
+
+
+def isLocal(device):
+    """Whether `device` is a simulator or a replay rather than a CU."""
+    return device.startswith((cusim.DEVICE_PREFIX, replaycu.DEVICE_PREFIX))
+
+
+class Transport(abc.ABC):
+    """Connection to one CU, the base class of all backends."""
+
+    POLL_REQUEST = b"generalQuery"
+    START_KEY = b"T2"
+
+    @abc.abstractmethod
+    async def poll(self):
+        """The next ControlUnit.Timer or, without any, ControlUnit.Status."""
+
+    @abc.abstractmethod
+    async def request(self, buf):
+        """Send `buf` and return the answer."""
+
+    @abc.abstractmethod
+    async def reset(self):
+        """Reset the CU clock."""
+
+    @abc.abstractmethod
+    async def version(self):
+        """The firmware version of the CU."""
+
+    async def start(self):
+        await self.request(self.START_KEY)
+
+    async def clear(self):
+        """Discard pending timer events, reset the CU clock and return
+        the last status."""
+        status = await self.poll()
+        while not isinstance(status, ControlUnit.Status):
+            status = await self.poll()
+        await self.reset()
+        return status
+
+    async def events(self, rate=POLL_RATE):
+        """Poll the CU and yield every new Timer and Status.
+
+        Answers with a wrong checksum are skipped.
+        """
+        scheduler = PollScheduler(rate)
+        last = None
+        while True:
+            try:
+                data = await self.poll()
+            except protocol.ChecksumError:
+                continue
+            await asyncio.sleep(
+                scheduler.next(isinstance(data, ControlUnit.Timer), data == last)
+            )
+            if data != last:
+                last = data
+                yield data
+
+    def close(self):
+        pass
+
+
+class LocalTransport(Transport):
+    """Stand-in for a CU, i.e. the simulator of cusim.py or a replay.
+
+    These never block, so they are called right in the event loop.
+    """
+
+    def __init__(self, cu):
+        self.cu = cu
+
+    async def call(self, func, *args):
+        return func(*args)
+
+    async def poll(self):
+        return await self.call(self.cu.poll)
+
+    async def request(self, buf):
+        return await self.call(self.cu.request, buf)
+
+    async def start(self):
+        await self.call(self.cu.start)
+
+    async def reset(self):
+        await self.call(self.cu.reset)
+
+    async def version(self):
+        return await self.call(self.cu.version)
+
+    def close(self):
+        self.cu.close()
+
+
+class ControlUnitTransport(LocalTransport):
+    """carreralib ControlUnit, over Bluetooth LE or serial.
+
+    carreralib blocks while it waits for the CU, so its calls run in a
+    worker thread of their own. There is only one, which keeps the
+    connection to one thread.
+    """
+
+    def __init__(self, cu):
+        super().__init__(cu)
+        self.executor = ThreadPoolExecutor(1)
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown()
+        super().close()
+
+
+class UDPTransport(Transport, asyncio.DatagramProtocol):
+    """The btserver bridge, which forwards UDP requests to the CU.
+
+    Like the ControlUnit of rms_UDP.py every request carries a sequence
+    number which the bridge copies into its answer, and is sent again if
+    it is not answered within REQUEST_TIMEOUT seconds. Key presses are
+    not repeated, since pressing a key twice is not the same as pressing
+    it once. The socket is opened by the first request, in the event
+    loop the transport is used from.
+    """
+
+    REQUEST_TIMEOUT = 0.25
+    REQUEST_RETRIES = 3
+    SEQ_MODULO = 10000
+
+    def __init__(self, host, port=UDP_PORT):
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.seq = 0
+        # futures of the answers by sequence number
+        self.pending = {}
+        self.decodeStatus = datagram.StatusDecoder()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: self, remote_addr=(self.host, self.port)
+        )
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        sep = data.find(b"#", 0, 6)
+        if sep < 1 or not data[:sep].isdigit():
+            return
+        future = self.pending.pop(int(data[:sep]), None)
+        if future is None or future.done():
+            return
+        if data[sep + 1 :] == b"nocu":
+            future.set_exception(IOError("No CU connected"))
+        else:
+            future.set_result((data, sep + 1))
+
+    async def exchange(self, buf, retries=None):
+        """Send `buf` and return the answer as datagram and the position
+        of the payload in it."""
+        if self.transport is None:
+            await self.connect()
+        if retries is None:
+            retries = 0 if buf.startswith(b"T") else self.REQUEST_RETRIES
+        loop = asyncio.get_running_loop()
+        while True:
+            self.seq = (self.seq + 1) % self.SEQ_MODULO
+            seq = self.seq
+            future = self.pending[seq] = loop.create_future()
+            self.transport.sendto(b"%d#%s" % (seq, buf))
+            try:
+                return await asyncio.wait_for(future, self.REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.pending.pop(seq, None)
+                if retries <= 0:
+                    raise
+                retries -= 1
+
+    async def request(self, buf):
+        data, pos = await self.exchange(buf)
+        return data[pos:]
+
+    async def poll(self):
+        while True:
+            data, pos = await self.exchange(self.POLL_REQUEST)
+            kind = data[pos : pos + 2]
+            if kind == b"?:":
+                parts = self.decodeStatus(data, pos)
+                if parts is None:
+                    raise protocol.ChecksumError("Invalid checksum %r" % data)
+                return ControlUnit.Status(*parts)
+            elif kind.startswith(b"?") and kind not in (b"?T", b"?="):
+                parts = datagram.decodeTimer(data, pos)
+                if parts is None:
+                    raise protocol.ChecksumError("Invalid checksum %r" % data)
+                address, timestamp, sector = parts
+                return ControlUnit.Timer(address - 1, timestamp, sector)
+            # echo of an earlier command, ask again
+
+    async def clear(self):
+        # the bridge discards the timer events itself and answers with
+        # the status, the "&" takes the place of the "?" of a status
+        while True:
+            data, pos = await self.exchange(b"clearCU")
+            if data.startswith(b"clearCU&:", pos):
+                parts = self.decodeStatus(data, pos + len(b"clearCU"))
+                if parts is not None:
+                    break
+        await self.reset()
+        return ControlUnit.Status(*parts)
+
+    async def reset(self):
+        # answered with "Reset&:", which carries nothing
+        await self.exchange(b"Reset")
+
+    async def version(self):
+        return protocol.unpack("x4sC", await self.request(b"Version"))[0]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def openTransport(device):
+    """Transport to the CU for a device argument of rms.py or udp:HOST[:PORT]."""
+    if device.startswith(DEVICE_PREFIX):
+        host, _, port = device[len(DEVICE_PREFIX) :].partition(":")
+        return UDPTransport(host, int(port or UDP_PORT))
+    elif isLocal(device):
+        return LocalTransport(openDevice(device))
+    return ControlUnitTransport(openDevice(device))
+
+
+async def main(device):
+    """Headless timing box printing every lap to stdout."""
+    transport = openTransport(device)
+    engine = RaceEngine()
+
+    def printLap(driver, timer):
+        if driver.lapTime is not None:
+            print(
+                "%s lap %d %d.%03d"
+                % (driver.name, driver.lapcount, *divmod(driver.lapTime, 1000))
+            )
+
+    engine.subscribe("lap", printLap)
+    try:
+        print("CU version", await transport.version())
+        await transport.clear()
+        async for data in transport.events():
+            if isinstance(data, ControlUnit.Status):
+                engine.handle_status(data)
+            else:
+                engine.handle_timer(data)
+    finally:
+        transport.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass